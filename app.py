@@ -1,21 +1,39 @@
 # app.py
+import time
+PROCESS_START = time.monotonic()  # 尽早记录，用于统计启动耗时
+
 from flask import Flask, request, jsonify, send_file, Response
 import tempfile
 import os
 import shutil
 import logging
 import magic
+import threading
 from pathlib import Path
 from werkzeug.utils import secure_filename
-from config import MAX_FILE_SIZE, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, MIME_TO_EXT
+from config import (
+    MAX_FILE_SIZE, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, ARCHIVE_EXTENSIONS, MIME_TO_EXT, CHECK_ALL_FILES,
+    CACHE_FILE_HASH_MAX_SIZE
+)
 from utils import ArchiveHandler, can_process_file, sort_files_by_priority
+import processors
 from processors import process_image, process_pdf_file, process_video_file, process_archive
+from cache import result_cache, make_key, sha256_file, copy_with_sha256
+from phash import phash_index
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# 启动耗时统计
+startup_stats = {
+    'import_seconds': None,
+    'ready_seconds': None,
+    'first_request_seconds': None
+}
+_first_request_lock = threading.Lock()
+
 # 文件上传配置
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE  # 从config导入的最大文件大小
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()  # 使用系统临时目录
@@ -47,6 +65,12 @@ class TempFileHandler:
                 logger.error(f"清理临时文件失败 {file_path}: {str(e)}")
         self.temp_files.clear()
 
+def parse_flag(value, default=False):
+    """解析请求中的布尔参数，未提供时使用默认值"""
+    if value is None or value == '':
+        return bool(default)
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
 def detect_file_type(file_path):
     """检测文件类型，使用文件的前2048字节"""
     try:
@@ -68,15 +92,19 @@ def detect_file_type(file_path):
         logger.error(f"文件类型检测失败: {str(e)}")
         raise
 
-def process_file_by_type(file_path, detected_type, original_filename, temp_handler):
-    """根据文件类型选择处理方法"""
+def process_file_by_type(file_path, detected_type, original_filename, temp_handler, check_all=False):
+    """根据文件类型选择处理方法
+
+    Args:
+        check_all: 为真时视频（包括压缩包中的视频）检测所有采样帧并返回时间线
+    """
     mime_type, ext = detected_type
     
     # 如果有原始文件扩展名，优先使用
     if original_filename and '.' in original_filename:
         original_ext = os.path.splitext(original_filename)[1].lower()
         if original_ext in IMAGE_EXTENSIONS or original_ext == '.pdf' or \
-           original_ext in VIDEO_EXTENSIONS or original_ext in {'.rar', '.zip', '.7z', '.gz'}:
+           original_ext in VIDEO_EXTENSIONS or original_ext in ARCHIVE_EXTENSIONS:
             ext = original_ext
     
     if not ext:
@@ -99,22 +127,21 @@ def process_file_by_type(file_path, detected_type, original_filename, temp_handl
                 }
                 
         elif ext == '.pdf':
-            with open(file_path, 'rb') as f:
-                pdf_stream = f.read()
-                result = process_pdf_file(pdf_stream)
-                if result:
-                    return {
-                        'status': 'success',
-                        'filename': original_filename,
-                        'result': result
-                    }
+            # 按路径打开，MuPDF 按需读取，不把整个文件读入内存
+            result = process_pdf_file(file_path)
+            if result:
                 return {
-                    'status': 'error',
-                    'message': 'No processable content found in PDF'
-                }, 400
+                    'status': 'success',
+                    'filename': original_filename,
+                    'result': result
+                }
+            return {
+                'status': 'error',
+                'message': 'No processable content found in PDF'
+            }, 400
                 
         elif ext in VIDEO_EXTENSIONS:
-            result = process_video_file(file_path)
+            result = process_video_file(file_path, check_all)
             if result:
                 return {
                     'status': 'success',
@@ -126,8 +153,8 @@ def process_file_by_type(file_path, detected_type, original_filename, temp_handl
                 'message': 'No processable content found in video'
             }, 400
                 
-        elif ext in {'.zip', '.rar', '.7z', '.gz'}:
-            return process_archive(file_path, original_filename)
+        elif ext in ARCHIVE_EXTENSIONS:
+            return process_archive(file_path, original_filename, check_all=check_all)
             
         else:
             logger.error(f"不支持的文件扩展名: {ext}")
@@ -143,6 +170,43 @@ def process_file_by_type(file_path, detected_type, original_filename, temp_handl
             'message': str(e)
         }, 500
 
+def file_cache_key(file_path, check_all=False, digest=None):
+    """生成文件级缓存键，不使用缓存时返回 None
+
+    上传的文件在写入磁盘时已经算好 digest；path 指定的文件需要额外完整读取一遍，
+    超过 CACHE_FILE_HASH_MAX_SIZE 时跳过，避免在提前结束的检测之前先读完整个大文件。
+    """
+    if not result_cache.enabled:
+        return None
+    if digest is None:
+        file_size = os.path.getsize(file_path)
+        if CACHE_FILE_HASH_MAX_SIZE and file_size > CACHE_FILE_HASH_MAX_SIZE:
+            logger.info(f"文件较大（{file_size} 字节），跳过文件级缓存")
+            return None
+        digest = sha256_file(file_path)
+    return make_key('file-timeline' if check_all else 'file', digest)
+
+def process_file_cached(file_path, detected_type, original_filename, temp_handler, check_all=False, digest=None):
+    """按文件内容的 SHA-256 查询结果缓存，未命中时再处理文件
+
+    Args:
+        digest: 文件内容的 SHA-256，已在上传时计算好则直接使用
+    """
+    cache_key = file_cache_key(file_path, check_all, digest)
+    if cache_key:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"文件命中缓存: {original_filename}")
+            cached['filename'] = original_filename
+            return cached
+
+    result = process_file_by_type(file_path, detected_type, original_filename, temp_handler, check_all)
+
+    # 只缓存成功的结果
+    if cache_key and isinstance(result, dict) and result.get('status') == 'success':
+        result_cache.set(cache_key, result)
+    return result
+
 @app.route('/')
 def index():
     """Serve the index.html file"""
@@ -155,6 +219,7 @@ def check_file():
     try:
         # 获取请求中的 path 参数
         path = request.form.get('path')
+        check_all = parse_flag(request.form.get('check_all'), CHECK_ALL_FILES)
         
         if path:
             # 处理文件路径
@@ -198,7 +263,7 @@ def check_file():
             logger.info(f"检测到文件类型: {detected_type}")
             
             # 处理文件
-            result = process_file_by_type(abs_path, detected_type, filename, temp_handler)
+            result = process_file_cached(abs_path, detected_type, filename, temp_handler, check_all)
             return jsonify(result) if isinstance(result, dict) else jsonify(result[0]), result[1] if isinstance(result, tuple) else 200
             
         # 文件上传处理逻辑
@@ -219,7 +284,13 @@ def check_file():
         logger.info(f"接收到文件: {filename}")
         
         temp_file = temp_handler.create_temp_file()
-        file.save(temp_file.name)
+        digest = None
+        with temp_file:
+            if result_cache.enabled:
+                # 写入磁盘的同时计算哈希，不必在检测前再完整读取一遍
+                digest = copy_with_sha256(file.stream, temp_file)
+            else:
+                file.save(temp_file)
         
         file_size = os.path.getsize(temp_file.name)
         if file_size > MAX_FILE_SIZE:
@@ -231,7 +302,7 @@ def check_file():
         detected_type = detect_file_type(temp_file.name)
         logger.info(f"检测到文件类型: {detected_type}")
         
-        result = process_file_by_type(temp_file.name, detected_type, filename, temp_handler)
+        result = process_file_cached(temp_file.name, detected_type, filename, temp_handler, check_all, digest)
         return jsonify(result) if isinstance(result, dict) else jsonify(result[0]), result[1] if isinstance(result, tuple) else 200
 
     except Exception as e:
@@ -244,6 +315,57 @@ def check_file():
     finally:
         # 清理所有临时文件
         temp_handler.cleanup()
+        _record_first_request()
+
+def _record_first_request():
+    """记录进程启动到第一个请求处理完成的时间"""
+    if startup_stats['first_request_seconds'] is not None:
+        return
+    with _first_request_lock:
+        if startup_stats['first_request_seconds'] is None:
+            startup_stats['first_request_seconds'] = time.monotonic() - PROCESS_START
+            logger.info(f"首个请求处理完成，距进程启动 {startup_stats['first_request_seconds']:.2f}秒")
+
+def startup():
+    """加载模型并预热，完成后 /readyz 返回就绪"""
+    try:
+        timings = processors.startup()
+        startup_stats.update(timings)
+        startup_stats['ready_seconds'] = time.monotonic() - PROCESS_START
+        logger.info(f"服务就绪，距进程启动 {startup_stats['ready_seconds']:.2f}秒")
+    except Exception as e:
+        logger.error(f"模型启动失败: {str(e)}")
+
+@app.route('/healthz')
+def healthz():
+    """存活检查：进程能够响应请求即可"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """就绪检查：模型已加载并完成预热，且还有存活的模型工作进程"""
+    status = processors.readiness()
+    if status == 'ready':
+        return jsonify({'status': 'ready'})
+    return jsonify({'status': status}), 503
+
+@app.route('/stats')
+def stats():
+    """返回运行时统计信息"""
+    engine = processors.engine
+    return jsonify({
+        'cache': result_cache.stats(),
+        'phash': phash_index.stats(),
+        'workers': engine.stats() if hasattr(engine, 'stats') else [],
+        'video': processors.video_stats(),
+        'prefilter': processors.prefilter_stats(),
+        'startup': startup_stats
+    })
+
+startup_stats['import_seconds'] = time.monotonic() - PROCESS_START
+logger.info(f"应用模块加载完成，耗时 {startup_stats['import_seconds']:.2f}秒")
 
 if __name__ == '__main__':
+    # 模型在后台加载，期间 /healthz 可用，/readyz 返回 503
+    threading.Thread(target=startup, name='startup', daemon=True).start()
     app.run(host='0.0.0.0', port=3333)
\ No newline at end of file
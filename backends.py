@@ -0,0 +1,298 @@
+# backends.py
+import os
+import time
+import inspect
+import logging
+import numpy as np
+from config import MODEL_NAME, INFERENCE_BACKEND, ONNX_MODEL_DIR
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+def resolve_model_path(model_name=MODEL_NAME):
+    """返回本地缓存的模型目录，所有后端都从同一份权重加载"""
+    if os.path.isdir(model_name):
+        return model_name
+    from huggingface_hub import snapshot_download
+    try:
+        return snapshot_download(model_name, local_files_only=True)
+    except Exception:
+        logger.warning(f"本地缓存中未找到模型 {model_name}，尝试下载")
+        return snapshot_download(model_name)
+
+def load_image_processor(model_name=MODEL_NAME):
+    """只加载模型的图片处理器配置（不加载权重）"""
+    from transformers import AutoImageProcessor
+    return AutoImageProcessor.from_pretrained(resolve_model_path(model_name))
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+class InferenceBackend:
+    """推理后端基类
+
+    所有后端都实现 classify(batch) -> [(nsfw, normal)]，
+    batch 为 PIL 图片列表，返回值与输入顺序一致。
+    classify_array(pixel_values) 接收已预处理好的 NCHW float32 数组。
+    supports_prescreen 表示能否接收低于模型原生分辨率的输入（用于级联预筛）。
+    """
+    name = None
+    supports_prescreen = False
+
+    def __init__(self, model_name=MODEL_NAME):
+        from transformers import AutoConfig
+        self.model_name = model_name
+        self.model_path = resolve_model_path(model_name)
+        self.config = AutoConfig.from_pretrained(self.model_path)
+        self.image_processor = load_image_processor(self.model_path)
+        label2id = {label.lower(): int(idx) for idx, label in self.config.id2label.items()}
+        self.nsfw_index = label2id.get('nsfw')
+        self.normal_index = label2id.get('normal')
+
+    def classify(self, batch):
+        return self.classify_array(self._pixel_values(batch))
+
+    def classify_array(self, pixel_values):
+        raise NotImplementedError
+
+    def _pixel_values(self, batch):
+        """使用模型自带的图片处理器生成 NCHW float32 输入"""
+        images = [img if img.mode == 'RGB' else img.convert('RGB') for img in batch]
+        return self.image_processor(images=images, return_tensors='np')['pixel_values'].astype(np.float32)
+
+    def _model_kwargs(self, model, pixel_values):
+        """输入尺寸与模型原生尺寸不同时，让 ViT 类模型插值位置编码"""
+        size = self.image_processor.size
+        native = (size.get('height'), size.get('width'))
+        if tuple(pixel_values.shape[-2:]) == native:
+            return {}
+        if 'interpolate_pos_encoding' in inspect.signature(model.forward).parameters:
+            return {'interpolate_pos_encoding': True}
+        return {}
+
+    def _scores(self, logits):
+        """把 logits 转换为 (nsfw, normal) 分数对"""
+        probs = _softmax(np.asarray(logits, dtype=np.float32))
+        scores = []
+        for row in probs:
+            nsfw = float(row[self.nsfw_index]) if self.nsfw_index is not None else 0.0
+            normal = float(row[self.normal_index]) if self.normal_index is not None else 1.0
+            scores.append((nsfw, normal))
+        return scores
+
+class TransformersBackend(InferenceBackend):
+    """原有的 transformers pipeline 后端（fp32）"""
+    name = 'transformers'
+    supports_prescreen = True
+
+    def __init__(self, model_name=MODEL_NAME):
+        super().__init__(model_name)
+        from transformers import pipeline
+        self.pipe = pipeline("image-classification", model=self.model_path, device=-1)
+
+    def classify(self, batch):
+        results = self.pipe(list(batch), batch_size=len(batch))
+        scores = []
+        for result in results:
+            nsfw = next((item['score'] for item in result if item['label'] == 'nsfw'), 0)
+            normal = next((item['score'] for item in result if item['label'] == 'normal'), 1)
+            scores.append((nsfw, normal))
+        return scores
+
+    def classify_array(self, pixel_values):
+        import torch
+        model = self.pipe.model
+        with torch.inference_mode():
+            logits = model(pixel_values=torch.from_numpy(pixel_values),
+                           **self._model_kwargs(model, pixel_values)).logits
+        return self._scores(logits.numpy())
+
+class QuantizedTorchBackend(InferenceBackend):
+    """对 Linear 层做动态 int8 量化的 torch 后端"""
+    name = 'int8'
+    supports_prescreen = True
+
+    def __init__(self, model_name=MODEL_NAME):
+        super().__init__(model_name)
+        import torch
+        from transformers import AutoModelForImageClassification
+        self.torch = torch
+        model = AutoModelForImageClassification.from_pretrained(self.model_path)
+        model.eval()
+        self.model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    def classify_array(self, pixel_values):
+        with self.torch.inference_mode():
+            logits = self.model(pixel_values=self.torch.from_numpy(pixel_values),
+                                **self._model_kwargs(self.model, pixel_values)).logits
+        return self._scores(logits.numpy())
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime 后端，首次使用时从本地权重导出 ONNX 模型
+
+    导出的模型固定为原生输入分辨率，因此不支持级联预筛。
+    """
+    name = 'onnx'
+
+    def __init__(self, model_name=MODEL_NAME, model_dir=ONNX_MODEL_DIR):
+        super().__init__(model_name)
+        import onnxruntime as ort
+        self.onnx_path = os.path.join(model_dir, model_name.strip('/').replace('/', '--') + '.onnx')
+        if not os.path.exists(self.onnx_path):
+            self._export()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            self.onnx_path, sess_options=options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _export(self):
+        import torch
+        from transformers import AutoModelForImageClassification
+        logger.info(f"导出 ONNX 模型: {self.onnx_path}")
+        os.makedirs(os.path.dirname(self.onnx_path), exist_ok=True)
+        model = AutoModelForImageClassification.from_pretrained(self.model_path)
+        model.eval()
+        size = self.image_processor.size
+        dummy = torch.zeros(1, 3, size['height'], size['width'])
+        # 先写入临时文件再改名，避免并发进程读到不完整的模型
+        temp_path = f"{self.onnx_path}.{os.getpid()}.tmp"
+        torch.onnx.export(
+            model,
+            (dummy,),
+            temp_path,
+            input_names=['pixel_values'],
+            output_names=['logits'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}},
+            opset_version=17,
+            dynamo=False
+        )
+        os.replace(temp_path, self.onnx_path)
+
+    def classify_array(self, pixel_values):
+        logits = self.session.run(None, {self.input_name: pixel_values})[0]
+        return self._scores(logits)
+
+BACKENDS = {
+    TransformersBackend.name: TransformersBackend,
+    QuantizedTorchBackend.name: QuantizedTorchBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+def create_backend(name=INFERENCE_BACKEND, model_name=MODEL_NAME):
+    """按名称创建推理后端"""
+    backend_class = BACKENDS.get(str(name).lower())
+    if backend_class is None:
+        raise ValueError(f"未知的推理后端: {name}，可选: {', '.join(BACKENDS)}")
+    start = time.monotonic()
+    backend = backend_class(model_name)
+    logger.info(f"推理后端已加载: {backend.name}, 模型={model_name}, "
+                f"耗时={time.monotonic() - start:.2f}秒")
+    return backend
+
+def check_parity(images, backend, reference, threshold):
+    """比较两个后端在同一批图片上的分数偏差
+
+    Args:
+        images: (名称, PIL 图片) 列表
+        backend: 待检查的后端
+        reference: 作为基准的 fp32 后端
+        threshold: 判定阈值，用于统计结论翻转的图片
+
+    Returns:
+        dict: 偏差统计和耗时对比
+    """
+    drifts = []
+    flipped = []
+    timings = {'backend': 0.0, 'reference': 0.0}
+    for name, image in images:
+        start = time.monotonic()
+        expected = reference.classify([image])[0][0]
+        timings['reference'] += time.monotonic() - start
+
+        start = time.monotonic()
+        actual = backend.classify([image])[0][0]
+        timings['backend'] += time.monotonic() - start
+
+        drifts.append(abs(actual - expected))
+        if (actual > threshold) != (expected > threshold):
+            flipped.append(name)
+
+    count = len(drifts)
+    return {
+        'backend': backend.name,
+        'reference': reference.name,
+        'images': count,
+        'max_drift': max(drifts) if drifts else 0.0,
+        'mean_drift': sum(drifts) / count if count else 0.0,
+        'flipped': flipped,
+        'reference_seconds': timings['reference'],
+        'backend_seconds': timings['backend'],
+        'speedup': timings['reference'] / timings['backend'] if timings['backend'] else 0.0
+    }
+
+def uncertainty_band(threshold, below, above):
+    """以判定阈值为中心的不确定区间 (low, high)，截断到 [0, 1]"""
+    return max(0.0, threshold - below), min(1.0, threshold + above)
+
+def in_uncertainty_band(nsfw_score, low, high):
+    """预筛分数落在不确定区间内时，需要交给全分辨率模型复核"""
+    return low <= nsfw_score <= high
+
+def check_cascade(samples, backend, prescreen, full, threshold, low, high):
+    """在带标签的图片上比较级联模式与只用全分辨率模型的准确率和耗时
+
+    Args:
+        samples: (名称, PIL 图片, 是否 NSFW) 列表
+        backend: 推理后端，需要支持低分辨率输入
+        prescreen: 预筛阶段使用的 Preprocessor
+        full: 全分辨率阶段使用的 Preprocessor
+        threshold: 判定阈值
+        low, high: 不确定区间的上下界
+
+    Returns:
+        dict: 两种模式的准确率、平均耗时以及复核比例
+    """
+    full_correct = cascade_correct = escalated = 0
+    full_seconds = cascade_seconds = 0.0
+    mismatched = []
+    for name, image, is_nsfw in samples:
+        start = time.monotonic()
+        full_score = backend.classify_array(full.normalize([full.load(image)]))[0][0]
+        full_time = time.monotonic() - start
+
+        start = time.monotonic()
+        score = backend.classify_array(prescreen.normalize([prescreen.load(image)]))[0][0]
+        cascade_time = time.monotonic() - start
+        if in_uncertainty_band(score, low, high):
+            escalated += 1
+            score = full_score
+            cascade_time += full_time
+
+        full_seconds += full_time
+        cascade_seconds += cascade_time
+        full_correct += (full_score > threshold) == is_nsfw
+        cascade_correct += (score > threshold) == is_nsfw
+        if (score > threshold) != (full_score > threshold):
+            mismatched.append(name)
+
+    count = len(samples)
+    return {
+        'backend': backend.name,
+        'images': count,
+        'band': [low, high],
+        'prescreen_size': list(prescreen.size),
+        'escalated': escalated,
+        'escalation_rate': escalated / count if count else 0.0,
+        'full_accuracy': full_correct / count if count else 0.0,
+        'cascade_accuracy': cascade_correct / count if count else 0.0,
+        'mismatched': mismatched,
+        'full_mean_ms': full_seconds / count * 1000 if count else 0.0,
+        'cascade_mean_ms': cascade_seconds / count * 1000 if count else 0.0,
+        'speedup': full_seconds / cascade_seconds if cascade_seconds else 0.0
+    }
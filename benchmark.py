@@ -0,0 +1,118 @@
+# benchmark.py
+"""离线评估工具
+
+用法:
+    python3 benchmark.py parity /path/to/images --backend int8
+    python3 benchmark.py cascade /path/to/labelled   # 子目录 nsfw/ 和 normal/ 作为标签
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+from PIL import Image
+from config import (
+    IMAGE_EXTENSIONS, NSFW_THRESHOLD, MODEL_NAME, INFERENCE_BACKEND,
+    CASCADE_PRESCREEN_SIZE, CASCADE_BAND_BELOW, CASCADE_BAND_ABOVE
+)
+from backends import BACKENDS, create_backend, check_parity, check_cascade, uncertainty_band
+from preprocess import Preprocessor
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+def load_corpus(corpus_dir, limit=0):
+    """递归加载目录中的图片，返回 (相对路径, PIL 图片) 列表"""
+    images = []
+    for root, _, files in os.walk(corpus_dir):
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(root, filename)
+            try:
+                with Image.open(path) as img:
+                    images.append((os.path.relpath(path, corpus_dir), img.convert('RGB')))
+            except Exception as e:
+                logger.warning(f"跳过无法打开的图片 {path}: {str(e)}")
+            if limit and len(images) >= limit:
+                return images
+    return images
+
+def run_parity(args):
+    images = load_corpus(args.corpus, args.limit)
+    if not images:
+        logger.error(f"目录中没有可用的图片: {args.corpus}")
+        return 1
+
+    reference = create_backend('transformers', args.model)
+    reports = []
+    for name in args.backend:
+        backend = create_backend(name, args.model)
+        reports.append(check_parity(images, backend, reference, args.threshold))
+
+    print(json.dumps(reports, indent=2, ensure_ascii=False))
+    return 0
+
+def run_cascade(args):
+    samples = []
+    for name, image in load_corpus(args.corpus, args.limit):
+        label = name.replace(os.sep, '/').split('/', 1)[0].lower()
+        if label not in ('nsfw', 'normal'):
+            logger.warning(f"跳过不在 nsfw/ 或 normal/ 子目录中的图片: {name}")
+            continue
+        samples.append((name, image, label == 'nsfw'))
+    if not samples:
+        logger.error(f"目录中没有带标签的图片: {args.corpus}")
+        return 1
+
+    backend = create_backend(args.backend, args.model)
+    if not backend.supports_prescreen:
+        logger.error(f"推理后端 {backend.name} 不支持低分辨率输入")
+        return 1
+    full = Preprocessor.from_image_processor(backend.image_processor)
+    low, high = uncertainty_band(args.threshold, args.band_below, args.band_above)
+    reports = []
+    for size in args.size:
+        prescreen = Preprocessor.from_image_processor(backend.image_processor, size=(size, size))
+        reports.append(check_cascade(samples, backend, prescreen, full,
+                                     args.threshold, low, high))
+
+    print(json.dumps(reports, indent=2, ensure_ascii=False))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='NSFW detector offline benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parity = subparsers.add_parser('parity', help='compare backend scores against fp32 transformers')
+    parity.add_argument('corpus', help='directory of local images')
+    parity.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                        help='backend to check (repeatable, default: int8 and onnx)')
+    parity.add_argument('--model', default=MODEL_NAME)
+    parity.add_argument('--threshold', type=float, default=NSFW_THRESHOLD)
+    parity.add_argument('--limit', type=int, default=0, help='maximum number of images (0 = all)')
+    parity.set_defaults(func=run_parity)
+
+    cascade = subparsers.add_parser('cascade', help='accuracy/latency of the low-resolution pre-screen cascade')
+    cascade.add_argument('corpus', help='directory with nsfw/ and normal/ subdirectories')
+    cascade.add_argument('--backend', default=INFERENCE_BACKEND, choices=sorted(BACKENDS))
+    cascade.add_argument('--model', default=MODEL_NAME)
+    cascade.add_argument('--size', type=int, action='append',
+                         help='pre-screen input edge in pixels (repeatable, default: CASCADE_PRESCREEN_SIZE)')
+    cascade.add_argument('--band-below', type=float, default=CASCADE_BAND_BELOW,
+                         help='width of the uncertainty band below --threshold')
+    cascade.add_argument('--band-above', type=float, default=CASCADE_BAND_ABOVE,
+                         help='width of the uncertainty band above --threshold')
+    cascade.add_argument('--threshold', type=float, default=NSFW_THRESHOLD)
+    cascade.add_argument('--limit', type=int, default=0, help='maximum number of images (0 = all)')
+    cascade.set_defaults(func=run_cascade)
+
+    args = parser.parse_args(argv)
+    if args.command == 'parity' and not args.backend:
+        args.backend = ['int8', 'onnx']
+    if args.command == 'cascade' and not args.size:
+        args.size = [int(CASCADE_PRESCREEN_SIZE)]
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# cache.py
+import os
+import copy
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from config import (
+    MODEL_NAME, INFERENCE_BACKEND, NSFW_THRESHOLD, CASCADE_ENABLED, CASCADE_PRESCREEN_SIZE,
+    CASCADE_BAND_BELOW, CASCADE_BAND_ABOVE, CACHE_ENABLED, CACHE_VERSION, CACHE_MEMORY_SIZE,
+    CACHE_DISK_PATH, CACHE_DISK_MAX_ENTRIES, CACHE_TTL
+)
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+def sha256_bytes(data):
+    """计算字节内容的 SHA-256"""
+    return hashlib.sha256(data).hexdigest()
+
+def sha256_file(file_path, chunk_size=1024 * 1024):
+    """分块计算文件的 SHA-256，避免整个文件读入内存"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_with_sha256(source, target, chunk_size=1024 * 1024):
+    """把数据流分块写入目标文件，同时计算 SHA-256，数据只读取一遍"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        digest.update(chunk)
+        target.write(chunk)
+    return digest.hexdigest()
+
+# 级联预筛给出的结论与全分辨率模型不同，预筛参数也作为缓存键的一部分
+_MODE = (f"cascade-{CASCADE_PRESCREEN_SIZE}-{CASCADE_BAND_BELOW}-{CASCADE_BAND_ABOVE}"
+         if CASCADE_ENABLED else 'full')
+
+def file_fingerprint(file_path, sample_size=1024 * 1024):
+    """文件内容指纹：文件大小加开头、中间、结尾各一段内容的 SHA-256
+
+    只读取少量数据，与路径无关，压缩包中解出的同一文件也能命中。
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(file_path, 'rb') as f:
+        if size <= sample_size * 3:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - sample_size) // 2, size - sample_size):
+                f.seek(offset)
+                digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+# int8/onnx 等后端的分数与 fp32 存在偏差，切换后端后不能复用其它后端的结果
+_BACKEND = str(INFERENCE_BACKEND).lower()
+
+def make_key(namespace, digest):
+    """生成缓存键，包含模型名称、推理后端、阈值、推理模式和缓存版本，任一变化都会使旧结果失效"""
+    return f"{namespace}:{MODEL_NAME}:{_BACKEND}:{NSFW_THRESHOLD}:{_MODE}:{CACHE_VERSION}:{digest}"
+
+class LRUCache:
+    """线程安全的内存 LRU 缓存"""
+    def __init__(self, max_size, ttl=0):
+        self.max_size = max(0, int(max_size))
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size == 0:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+class DiskCache:
+    """基于 SQLite 的持久化缓存，服务重启后仍然有效"""
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, path, max_entries, ttl=0):
+        self.path = path
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_results_created ON results(created)')
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl and created + self.ttl < time.time():
+                self._conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                self._conn.commit()
+                return None
+            return json.loads(value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, created) VALUES (?, ?, ?)',
+                (key, json.dumps(value), time.time())
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL == 0:
+                self._prune()
+            self._conn.commit()
+
+    def _prune(self):
+        """删除过期条目，并在超出容量时淘汰最旧的条目"""
+        if self.ttl:
+            self._conn.execute('DELETE FROM results WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_entries:
+            count = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    'DELETE FROM results WHERE key IN '
+                    '(SELECT key FROM results ORDER BY created ASC LIMIT ?)',
+                    (excess,)
+                )
+
+class ResultCache:
+    """两级结果缓存：先查内存 LRU，再查磁盘"""
+    def __init__(self, enabled=CACHE_ENABLED, memory_size=CACHE_MEMORY_SIZE,
+                 disk_path=CACHE_DISK_PATH, disk_max_entries=CACHE_DISK_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.enabled = bool(enabled)
+        self.memory = LRUCache(memory_size, ttl)
+        self.disk = None
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+        if self.enabled and disk_path:
+            try:
+                self.disk = DiskCache(disk_path, disk_max_entries, ttl)
+                logger.info(f"结果缓存已启用: 内存容量={memory_size}, 磁盘路径={disk_path}")
+            except Exception as e:
+                logger.error(f"磁盘缓存初始化失败，仅使用内存缓存: {str(e)}")
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, key):
+        """查询缓存，未命中时返回 None"""
+        if not self.enabled:
+            return None
+
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            return copy.deepcopy(value)
+
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except Exception as e:
+                logger.error(f"读取磁盘缓存失败: {str(e)}")
+                value = None
+            if value is not None:
+                self._count('disk_hits')
+                self.memory.set(key, value)
+                return copy.deepcopy(value)
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        """写入两级缓存"""
+        if not self.enabled:
+            return
+        self.memory.set(key, copy.deepcopy(value))
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except Exception as e:
+                logger.error(f"写入磁盘缓存失败: {str(e)}")
+
+    def stats(self):
+        """返回命中/未命中计数"""
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = sum(counters.values())
+        hits = counters['memory_hits'] + counters['disk_hits']
+        counters.update({
+            'enabled': self.enabled,
+            'memory_entries': len(self.memory),
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+        })
+        return counters
+
+# 全局共享的结果缓存
+result_cache = ResultCache()
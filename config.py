@@ -132,6 +132,7 @@ MIME_TO_EXT = {
     'application/x-xz': '.xz',
     'application/x-lzma': '.lzma',
     'application/x-zstd': '.zst',
+    'application/zstd': '.zst',
     'application/vnd.ms-cab-compressed': '.cab'
 }
 
@@ -166,6 +167,53 @@ FFMPEG_MAX_FRAMES = 20
 FFMPEG_TIMEOUT = 1800
 CHECK_ALL_FILES = 0
 MAX_INTERVAL_SECONDS = 30
+VIDEO_SAMPLING_MODE = 'fps'  # 视频采样方式: fps（顺序解码按固定帧率采样）/ seek（并行定位关键帧）/ scene（按镜头切换采样）
+VIDEO_SEEK_WORKERS = 4       # seek/scene 模式下同时运行的 ffmpeg 进程数
+VIDEO_SCENE_THRESHOLD = 0.3  # scene 模式下判定为镜头切换的场景分数阈值（0-1）
+VIDEO_FRAME_DEDUP_DISTANCE = 6  # 同一视频中帧 dHash 汉明距离不超过该值时复用分数，0 表示不去重
+MODEL_NAME = "Falconsai/nsfw_image_detection"
+INFERENCE_BACKEND = 'transformers'                 # 推理后端: transformers / int8 / onnx
+ONNX_MODEL_DIR = '/root/.cache/nsfw_detector/onnx' # 导出的 ONNX 模型存放目录
+
+ARCHIVE_WORKERS = 4          # 并行解压和检测压缩包成员的线程数
+NESTED_ARCHIVE_MEMORY_LIMIT = 64 * 1024 * 1024  # 嵌套的 ZIP/GZ 压缩包不超过该大小时只在内存中打开，超过时转存到匿名临时文件
+PDF_WORKERS = 4              # PDF 图片提取和解码的线程数，也是页面渲染的进程数
+PDF_RENDER_MODE = 'fallback' # PDF 页面渲染方式: off（只检测内嵌图片）/ fallback（图片未命中时渲染含图形内容但没有可检测图片的页面）/ all（图片未命中时渲染所有页面）
+PDF_RENDER_MAX_PAGES = 50    # 单个 PDF 最多渲染的页数，超出时在候选页中均匀抽样
+IMAGE_MIN_PIXELS = 4096      # PDF 和压缩包中像素面积小于该值的图片（图标、间隔图）不参与检测
+IMAGE_MAX_ASPECT_RATIO = 10  # PDF 和压缩包中长宽比超过该值的图片（分隔线、条带）不参与检测
+
+# 推理批处理配置
+BATCH_MAX_SIZE = 16          # 单批最多图片数
+BATCH_MAX_WAIT_MS = 10       # 凑批最长等待时间（毫秒）
+
+WARMUP_BATCHES = 2           # 启动时用于预热的空白批次数
+
+# 级联预筛配置：先用低分辨率输入打分，只有落在不确定区间内的图片才交给全分辨率模型
+CASCADE_ENABLED = 0
+CASCADE_PRESCREEN_SIZE = 112 # 预筛输入边长（像素），ViT 模型应为 patch 大小的整数倍
+# 不确定区间以 NSFW_THRESHOLD 为中心，总是包含阈值，预筛不会独自给出与阈值矛盾的结论
+CASCADE_BAND_BELOW = 0.6     # 区间在阈值以下的宽度，预筛分数低于 阈值-宽度 时直接判定为正常
+CASCADE_BAND_ABOVE = 0.15    # 区间在阈值以上的宽度，预筛分数高于 阈值+宽度 时直接判定为 NSFW
+
+# 模型工作进程配置
+WORKER_PROCESSES = 0         # 模型工作进程数，0 表示在服务进程内推理
+WORKER_TORCH_THREADS = 0     # 每个工作进程的 torch 线程数，0 表示按分配的 CPU 数自动设置
+WORKER_PIN_CPUS = 1          # 是否把每个工作进程绑定到一组 CPU
+
+# 结果缓存配置
+CACHE_ENABLED = 1
+CACHE_VERSION = 1                                  # 修改后使所有旧缓存失效
+CACHE_MEMORY_SIZE = 10000                          # 内存 LRU 最大条目数
+CACHE_DISK_PATH = '/tmp/nsfw_detector_cache.db'    # 磁盘缓存路径，留空则禁用
+CACHE_DISK_MAX_ENTRIES = 1000000                   # 磁盘缓存最大条目数
+CACHE_TTL = 7 * 24 * 3600                          # 缓存有效期（秒），0 表示永不过期
+CACHE_FILE_HASH_MAX_SIZE = 256 * 1024 * 1024       # path 指定的文件超过该大小时跳过文件级缓存，0 表示不限制
+
+# 感知哈希近似去重配置
+PHASH_ENABLED = 1
+PHASH_MAX_DISTANCE = 4       # 判定为近似重复的最大汉明距离（64位 dHash）
+PHASH_INDEX_SIZE = 100000    # 索引最大条目数
 
 # 从文件加载配置并更新全局变量
 file_config = load_config_from_file()
@@ -178,5 +226,12 @@ __all__ = [
     'MIME_TO_EXT', 'IMAGE_EXTENSIONS', 'VIDEO_EXTENSIONS', 'ARCHIVE_EXTENSIONS',
     'IMAGE_MIME_TYPES', 'VIDEO_MIME_TYPES', 'ARCHIVE_MIME_TYPES', 'PDF_MIME_TYPES',
     'SUPPORTED_MIME_TYPES', 'MAX_FILE_SIZE', 'NSFW_THRESHOLD', 'FFMPEG_MAX_FRAMES', 
-    'FFMPEG_TIMEOUT', 'CHECK_ALL_FILES', 'MAX_INTERVAL_SECONDS'
+    'FFMPEG_TIMEOUT', 'CHECK_ALL_FILES', 'MAX_INTERVAL_SECONDS',
+    'ARCHIVE_WORKERS', 'NESTED_ARCHIVE_MEMORY_LIMIT', 'PDF_WORKERS', 'PDF_RENDER_MODE', 'PDF_RENDER_MAX_PAGES', 'IMAGE_MIN_PIXELS', 'IMAGE_MAX_ASPECT_RATIO', 'VIDEO_SAMPLING_MODE', 'VIDEO_SEEK_WORKERS', 'VIDEO_SCENE_THRESHOLD', 'VIDEO_FRAME_DEDUP_DISTANCE',
+    'MODEL_NAME', 'INFERENCE_BACKEND', 'ONNX_MODEL_DIR', 'BATCH_MAX_SIZE', 'BATCH_MAX_WAIT_MS',
+    'WARMUP_BATCHES', 'CASCADE_ENABLED', 'CASCADE_PRESCREEN_SIZE', 'CASCADE_BAND_BELOW',
+    'CASCADE_BAND_ABOVE', 'WORKER_PROCESSES', 'WORKER_TORCH_THREADS', 'WORKER_PIN_CPUS',
+    'CACHE_ENABLED', 'CACHE_VERSION', 'CACHE_MEMORY_SIZE', 'CACHE_DISK_PATH',
+    'CACHE_DISK_MAX_ENTRIES', 'CACHE_TTL', 'CACHE_FILE_HASH_MAX_SIZE',
+    'PHASH_ENABLED', 'PHASH_MAX_DISTANCE', 'PHASH_INDEX_SIZE'
 ]
\ No newline at end of file
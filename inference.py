@@ -0,0 +1,128 @@
+# inference.py
+import threading
+import queue
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+class BatchScheduler:
+    """跨请求的微批处理调度器
+
+    调用方把图片提交到队列，后台线程按照最大批大小和最大等待时间
+    收集成批，执行一次模型前向计算后把结果分发回各个调用方。
+    concurrency 大于 1 时（多个模型工作进程），最多同时执行 concurrency 批，
+    所有执行槽都被占用时不再收集新批，让排队的图片凑成更大的批。
+    """
+    def __init__(self, runner, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, concurrency=1):
+        """
+        Args:
+            runner: 批处理函数，接收图片列表，返回与输入等长的结果列表
+            max_batch_size: 单批最多包含的图片数量
+            max_wait_ms: 收集一批时最多等待的毫秒数
+            concurrency: 同时执行的批数量
+        """
+        self.runner = runner
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.concurrency = max(1, int(concurrency))
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(self.concurrency)
+        self._executor = None
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                thread_name_prefix='batch-runner')
+
+    def start(self):
+        """启动后台批处理线程（重复调用无副作用）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._worker,
+                    name='batch-scheduler',
+                    daemon=True
+                )
+                self._thread.start()
+                logger.info(f"批处理调度器已启动: 批大小={self.max_batch_size}, "
+                            f"等待时间={self.max_wait * 1000:.1f}ms")
+
+    def submit(self, item):
+        """提交单张图片，返回 Future"""
+        self.start()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit_many(self, items):
+        """批量提交图片，返回与输入顺序一致的 Future 列表"""
+        return [self.submit(item) for item in items]
+
+    def _collect(self):
+        """阻塞等待第一项，然后在截止时间内尽量凑满一批"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            self._slots.acquire()
+            batch = self._collect()
+            # 跳过已被调用方取消的请求
+            batch = [(item, future) for item, future in batch
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                self._slots.release()
+                continue
+
+            if self._executor is None:
+                self._run_batch(batch)
+            else:
+                self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        try:
+            self._execute(batch)
+        finally:
+            self._slots.release()
+
+    def _execute(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            start = time.monotonic()
+            results = self.runner(items)
+            logger.debug(f"批处理完成: 数量={len(items)}, "
+                         f"耗时={(time.monotonic() - start) * 1000:.1f}ms")
+            if len(results) != len(items):
+                raise RuntimeError(f"批处理结果数量不匹配: {len(results)} != {len(items)}")
+        except Exception as e:
+            logger.error(f"批处理推理失败: {str(e)}")
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # 逐张重试，避免一张损坏的图片拖垮整批
+            for item, future in batch:
+                self._run_single(item, future)
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run_single(self, item, future):
+        try:
+            future.set_result(self.runner([item])[0])
+        except Exception as e:
+            future.set_exception(e)
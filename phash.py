@@ -0,0 +1,134 @@
+# phash.py
+import logging
+import threading
+from collections import deque
+import numpy as np
+from PIL import Image
+from config import PHASH_ENABLED, PHASH_MAX_DISTANCE, PHASH_INDEX_SIZE
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# 纯色/无纹理图片的哈希没有区分度，不参与近似匹配
+DEGENERATE_HASHES = {0, (1 << HASH_BITS) - 1}
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+def dhash(image, hash_size=HASH_SIZE):
+    """计算差值哈希（dHash）：在 (hash_size+1) x hash_size 的灰度缩略图上比较相邻像素
+
+    Args:
+        image: PIL 图片或 HxWx3 的 uint8 数组
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if image.mode != 'L':
+        image = image.convert('L')
+    thumb = image.resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(thumb, dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """按汉明距离组织的 BK 树，支持在给定距离内查找最近的哈希"""
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, payload):
+        """插入哈希，返回新建的节点；哈希已存在时只替换 payload，返回 None"""
+        node = self.root
+        if node is None:
+            self.root = [value, payload, {}]
+            self.size = 1
+            return self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1] = payload
+                return None
+            child = node[2].get(distance)
+            if child is None:
+                child = node[2][distance] = [value, payload, {}]
+                self.size += 1
+                return child
+            node = child
+
+    def find(self, value, max_distance):
+        """返回距离最近且不超过 max_distance 的 (距离, payload)，找不到返回 None"""
+        if self.root is None:
+            return None
+        best = None
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node[1])
+                if distance == 0:
+                    break
+            low, high = distance - max_distance, distance + max_distance
+            candidates.extend(child for d, child in node[2].items() if low <= d <= high)
+        return best
+
+class PerceptualIndex:
+    """进程内共享的感知哈希索引，用于复用近似重复图片的检测结果
+
+    容量满时丢弃最旧的一半条目并重建 BK 树。
+    """
+    def __init__(self, enabled=PHASH_ENABLED, max_distance=PHASH_MAX_DISTANCE, max_size=PHASH_INDEX_SIZE):
+        self.enabled = bool(enabled)
+        self.max_distance = int(max_distance)
+        self.max_size = max(1, int(max_size))
+        self._tree = BKTree()
+        self._entries = deque()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+
+    def lookup(self, value):
+        """查找近似重复的结果，未命中返回 None"""
+        if not self.enabled or value in DEGENERATE_HASHES:
+            return None
+        with self._lock:
+            match = self._tree.find(value, self.max_distance)
+            self._counters['hits' if match else 'misses'] += 1
+        if match is None:
+            return None
+        distance, result = match
+        logger.info(f"感知哈希命中: 汉明距离={distance}")
+        return dict(result)
+
+    def add(self, value, result):
+        if not self.enabled or value in DEGENERATE_HASHES:
+            return
+        with self._lock:
+            # 只记录新插入的节点，相同哈希重复写入不会让条目无限增长
+            node = self._tree.add(value, dict(result))
+            if node is not None:
+                self._entries.append(node)
+            if self._tree.size > self.max_size:
+                self._rebuild()
+
+    def _rebuild(self):
+        for _ in range(len(self._entries) // 2):
+            self._entries.popleft()
+        entries, self._entries = self._entries, deque()
+        self._tree = BKTree()
+        for value, result, _ in entries:
+            self._entries.append(self._tree.add(value, result))
+        logger.info(f"感知哈希索引已重建: 条目数={self._tree.size}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = self._tree.size
+        stats['enabled'] = self.enabled
+        return stats
+
+# 全局共享的感知哈希索引（视频帧、PDF 图片和压缩包成员共用）
+phash_index = PerceptualIndex()
@@ -0,0 +1,77 @@
+# preprocess.py
+import logging
+import numpy as np
+from PIL import Image
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+class Preprocessor:
+    """NumPy 预处理快速路径
+
+    JPEG 通过 Image.draft() 在 DCT 阶段按比例缩小解码，其它格式通过
+    resize 的 reducing_gap 先整数倍缩小，再缩放到模型输入尺寸。
+    归一化和通道变换在整批数据上一次完成，均值/方差取自模型的图片处理器配置。
+    """
+    def __init__(self, size, image_mean, image_std, rescale_factor=1 / 255,
+                 resample=Image.BILINEAR, do_rescale=True, do_normalize=True):
+        self.height, self.width = size
+        self.resample = resample
+        mean = np.asarray(image_mean if do_normalize else [0.0, 0.0, 0.0], dtype=np.float32)
+        std = np.asarray(image_std if do_normalize else [1.0, 1.0, 1.0], dtype=np.float32)
+        scale = np.float32(rescale_factor if do_rescale else 1.0)
+        # (x * scale - mean) / std 合并为一次乘加
+        self._mul = (scale / std).reshape(1, 3, 1, 1)
+        self._add = (-mean / std).reshape(1, 3, 1, 1)
+
+    @classmethod
+    def from_image_processor(cls, image_processor, size=None):
+        """从 transformers 的图片处理器读取尺寸、均值和方差
+
+        Args:
+            size: 覆盖输入尺寸 (高, 宽)，默认使用模型原生尺寸
+        """
+        if size is None:
+            native = image_processor.size
+            if 'height' in native and 'width' in native:
+                size = (native['height'], native['width'])
+            else:
+                edge = native.get('shortest_edge', 224)
+                size = (edge, edge)
+        return cls(
+            size,
+            image_processor.image_mean,
+            image_processor.image_std,
+            rescale_factor=getattr(image_processor, 'rescale_factor', 1 / 255),
+            resample=getattr(image_processor, 'resample', Image.BILINEAR),
+            do_rescale=getattr(image_processor, 'do_rescale', True),
+            do_normalize=getattr(image_processor, 'do_normalize', True)
+        )
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def load(self, image):
+        """解码并缩放到模型输入尺寸，返回 HxWx3 的 uint8 数组"""
+        # 必须在图片数据真正加载前调用，已加载的图片 draft 不生效
+        if getattr(image, 'format', None) == 'JPEG':
+            try:
+                image.draft('RGB', self.size)
+            except Exception as e:
+                logger.debug(f"JPEG 缩小解码失败，使用完整解码: {str(e)}")
+
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if image.size != self.size:
+            image = image.resize(self.size, self.resample, reducing_gap=3.0)
+        return np.asarray(image, dtype=np.uint8)
+
+    def normalize(self, arrays):
+        """把多张 HxWx3 uint8 数组合并为归一化后的 NCHW float32 批数据"""
+        batch = np.empty((len(arrays), 3, self.height, self.width), dtype=np.float32)
+        for index, array in enumerate(arrays):
+            batch[index] = array.transpose(2, 0, 1)
+        batch *= self._mul
+        batch += self._add
+        return batch
@@ -1,328 +1,1484 @@
 # processors.py
-from transformers import pipeline
 import subprocess
+import math
+import heapq
+from collections import deque
+import json
+import re
 import numpy as np
 from PIL import Image
-import fitz
 import io
 import logging
 import tempfile
 import os
 import shutil
-import glob
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils import ArchiveHandler, can_process_file, sort_files_by_priority
+import threading
+import queue
+import uuid
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+)
+from concurrent.futures.process import BrokenProcessPool
+from utils import ArchiveHandler, IN_MEMORY_ARCHIVE_EXTENSIONS, can_process_file, sort_files_by_priority
+from inference import BatchScheduler
+from backends import create_backend, load_image_processor, in_uncertainty_band, uncertainty_band
+from workers import ModelWorkerPool
+from preprocess import Preprocessor
+from cache import result_cache, make_key, sha256_bytes, file_fingerprint
+from phash import phash_index, dhash, BKTree, DEGENERATE_HASHES
 from config import (
     MAX_FILE_SIZE, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, 
-    NSFW_THRESHOLD, FFMPEG_MAX_FRAMES, FFMPEG_TIMEOUT,ARCHIVE_EXTENSIONS
+    NSFW_THRESHOLD, FFMPEG_MAX_FRAMES, FFMPEG_TIMEOUT,ARCHIVE_EXTENSIONS, CHECK_ALL_FILES,
+    MAX_INTERVAL_SECONDS, VIDEO_SAMPLING_MODE, VIDEO_SEEK_WORKERS, VIDEO_SCENE_THRESHOLD,
+    VIDEO_FRAME_DEDUP_DISTANCE, ARCHIVE_WORKERS, PDF_WORKERS, PDF_RENDER_MODE, PDF_RENDER_MAX_PAGES,
+    IMAGE_MIN_PIXELS, IMAGE_MAX_ASPECT_RATIO, NESTED_ARCHIVE_MEMORY_LIMIT,
+    WORKER_PROCESSES, WARMUP_BATCHES, CASCADE_ENABLED, CASCADE_PRESCREEN_SIZE,
+    CASCADE_BAND_BELOW, CASCADE_BAND_ABOVE
 )
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
-# 初始化模型
-pipe = pipeline("image-classification", model="Falconsai/nsfw_image_detection", device=-1)
+# 推理引擎：WORKER_PROCESSES 为 0 时在本进程加载模型，否则使用多进程工作池
+# 延迟到第一次使用时初始化，避免 spawn 出的工作进程在导入本模块时重复加载模型
+engine = None
+preprocessor = None
+prescreen_preprocessor = None  # 级联模式下预筛阶段的低分辨率预处理器，未启用时为 None
+_engine_lock = threading.Lock()
+_ready = threading.Event()
+
+def get_engine():
+    """返回推理引擎（本地后端或工作进程池），首次调用时加载"""
+    global engine, preprocessor, prescreen_preprocessor
+    if engine is not None:
+        return engine
+    with _engine_lock:
+        if engine is None:
+            image_processor = load_image_processor()
+            preprocessor = Preprocessor.from_image_processor(image_processor)
+            if WORKER_PROCESSES > 0:
+                loaded = ModelWorkerPool(
+                    input_size=(preprocessor.height, preprocessor.width)
+                ).start()
+            else:
+                loaded = create_backend()
+            if CASCADE_ENABLED:
+                if CASCADE_BAND_BELOW <= 0 or CASCADE_BAND_ABOVE <= 0:
+                    # 宽度为 0 时区间一端与阈值重合，预筛会独自给出贴近阈值的结论
+                    logger.error(f"级联预筛区间宽度必须大于 0 (below={CASCADE_BAND_BELOW}, "
+                                 f"above={CASCADE_BAND_ABOVE})，级联预筛未启用")
+                elif loaded.supports_prescreen:
+                    prescreen_size = int(CASCADE_PRESCREEN_SIZE)
+                    prescreen_preprocessor = Preprocessor.from_image_processor(
+                        image_processor, size=(prescreen_size, prescreen_size)
+                    )
+                    low, high = uncertainty_band(NSFW_THRESHOLD, CASCADE_BAND_BELOW, CASCADE_BAND_ABOVE)
+                    logger.info(f"级联预筛已启用: 预筛尺寸={CASCADE_PRESCREEN_SIZE}, "
+                                f"不确定区间=[{low:.3f}, {high:.3f}]")
+                else:
+                    logger.warning("当前推理后端不支持低分辨率输入，级联预筛未启用")
+            engine = loaded
+    return engine
+
+def _classify_batch(arrays):
+    """对一批已缩放的像素数组执行一次前向计算"""
+    return [
+        {'nsfw': nsfw_score, 'normal': normal_score}
+        for nsfw_score, normal_score in get_engine().classify_array(preprocessor.normalize(arrays))
+    ]
+
+def _classify_prescreen_batch(arrays):
+    """级联预筛：对一批低分辨率像素数组打分"""
+    return [
+        {'nsfw': nsfw_score, 'normal': normal_score}
+        for nsfw_score, normal_score in get_engine().classify_array(prescreen_preprocessor.normalize(arrays))
+    ]
+
+# 跨请求的批处理调度器，所有图片推理都经由它进入模型
+scheduler = BatchScheduler(_classify_batch, concurrency=max(1, WORKER_PROCESSES))
+# 预筛输入尺寸不同，不能与全分辨率图片合批，单独使用一个调度器
+prescreen_scheduler = BatchScheduler(_classify_prescreen_batch, concurrency=max(1, WORKER_PROCESSES))
+
+def _chain(source, target, stage):
+    """把 source 的结果标注阶段后转交给 target"""
+    def done(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            target.set_exception(e)
+            return
+        result['stage'] = stage
+        target.set_result(result)
+    source.add_done_callback(done)
+
+def _submit_cascade(pixels):
+    """级联推理：先提交低分辨率预筛，分数落在不确定区间内时再提交全分辨率模型
+
+    Returns:
+        Future: 结果中的 stage 字段标明由哪个阶段给出结论
+    """
+    outcome = Future()
+    outcome.set_running_or_notify_cancel()
+    small = prescreen_preprocessor.load(Image.fromarray(pixels))
+
+    def on_prescreen(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.warning(f"预筛失败，改用全分辨率模型: {str(e)}")
+            _chain(scheduler.submit(pixels), outcome, 'full')
+            return
+        low, high = uncertainty_band(NSFW_THRESHOLD, CASCADE_BAND_BELOW, CASCADE_BAND_ABOVE)
+        if in_uncertainty_band(result['nsfw'], low, high):
+            _chain(scheduler.submit(pixels), outcome, 'full')
+        else:
+            result['stage'] = 'prescreen'
+            outcome.set_result(result)
+
+    prescreen_scheduler.submit(small).add_done_callback(on_prescreen)
+    return outcome
+
+def startup(warmup_batches=WARMUP_BATCHES):
+    """显式启动阶段：加载模型并用空白批数据预热，完成后标记为就绪
+
+    Returns:
+        dict: 模型加载和预热耗时（秒）
+    """
+    start = time.monotonic()
+    get_engine()
+    load_seconds = time.monotonic() - start
+
+    start = time.monotonic()
+    warmups = [(scheduler, preprocessor)]
+    if prescreen_preprocessor is not None:
+        warmups.append((prescreen_scheduler, prescreen_preprocessor))
+    for _ in range(max(0, int(warmup_batches))):
+        # 直接提交到调度器，绕过缓存，保证真正执行前向计算
+        for target, target_preprocessor in warmups:
+            blank = np.zeros((target_preprocessor.height, target_preprocessor.width, 3), dtype=np.uint8)
+            futures = target.submit_many([blank] * target.max_batch_size)
+            for future in futures:
+                future.result()
+    warmup_seconds = time.monotonic() - start
+
+    _ready.set()
+    logger.info(f"模型已就绪: 加载耗时={load_seconds:.2f}秒, "
+                f"预热耗时={warmup_seconds:.2f}秒 ({warmup_batches} 批)")
+    return {'load_seconds': load_seconds, 'warmup_seconds': warmup_seconds}
+
+def readiness():
+    """返回 'starting'（加载或预热中）、'unavailable'（已没有存活的模型工作进程）或 'ready'"""
+    if not _ready.is_set():
+        return 'starting'
+    if not getattr(engine, 'healthy', True):
+        return 'unavailable'
+    return 'ready'
+
+def is_ready():
+    """模型已加载、完成预热并且还有可用的推理进程"""
+    return readiness() == 'ready'
+
+def _parse_number(value):
+    """解析 ffprobe 输出的数值字段，缺失或为 N/A 时返回 None"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 and math.isfinite(number) else None
+
+def _parse_rate(value):
+    """解析 30000/1001 形式的帧率"""
+    if not value:
+        return None
+    if '/' in str(value):
+        num, den = str(value).split('/', 1)
+        num, den = _parse_number(num), _parse_number(den)
+        return num / den if num and den else None
+    return _parse_number(value)
+
+def refill_timestamps(duration, sampled, count):
+    """把 count 个新采样点依次放到已采样时间点之间最大空隙的中点"""
+    points = sorted(set([0.0, duration] + list(sampled)))
+    gaps = [(-(b - a), a, b) for a, b in zip(points, points[1:]) if b > a]
+    heapq.heapify(gaps)
+    added = []
+    for _ in range(count):
+        if not gaps:
+            break
+        _, a, b = heapq.heappop(gaps)
+        middle = (a + b) / 2
+        added.append(middle)
+        heapq.heappush(gaps, (-(middle - a), a, middle))
+        heapq.heappush(gaps, (-(b - middle), middle, b))
+    return sorted(added)
+
+def plan_scene_samples(duration, scenes, budget, max_interval, min_gap=2.0):
+    """根据场景切换点规划采样时间点
+
+    优先选择场景切换分数最高的时间点（彼此至少相隔 min_gap 秒），
+    然后在超过 max_interval 的空隙中均匀补点，保证任意相邻采样点
+    （包括视频开头和结尾）之间的间隔都不超过 max_interval。
+    总帧数尽量不超过 budget；仅靠补点就需要更多帧时，以间隔保证为准，
+    此时只加入不会进一步增加帧数的切换点。
+
+    Args:
+        duration: 视频时长（秒）
+        scenes: (时间点, 场景切换分数) 列表
+        budget: 采样帧数预算
+        max_interval: 相邻采样点的最大间隔（秒）
+
+    Returns:
+        list: 升序排列的采样时间点
+    """
+    ranked = sorted(scenes, key=lambda scene: scene[1], reverse=True)
+
+    def plan(scene_budget):
+        chosen = []
+        for timestamp, _ in ranked:
+            if len(chosen) >= scene_budget:
+                break
+            if 0 <= timestamp < duration and all(abs(timestamp - other) >= min_gap for other in chosen):
+                chosen.append(timestamp)
+        points = sorted(chosen)
+        filled = []
+        previous = 0.0
+        for boundary in points + [duration]:
+            gap = boundary - previous
+            if gap > max_interval:
+                count = math.ceil(gap / max_interval) - 1
+                # 视频开头没有采样点时，从第一个区间的中间开始
+                filled.extend(previous + gap * (index + 1) / (count + 1) for index in range(count))
+            previous = boundary
+        if not points and not filled:
+            filled.append(duration / 2)
+        return sorted(points + filled)
+
+    # 仅靠补点就超出预算时，预算放宽到满足间隔保证所需的最少帧数
+    limit = max(int(budget), len(plan(0)))
+    for scene_budget in range(limit, 0, -1):
+        samples = plan(scene_budget)
+        if len(samples) <= limit:
+            return samples
+    return plan(0)
+
+# 内嵌图片预过滤统计，供 /stats 使用
+_prefilter_counters = {'checked': 0, 'small': 0, 'aspect': 0, 'mask': 0}
+_prefilter_lock = threading.Lock()
+
+def prefilter_reason(width, height):
+    """只根据尺寸判断内嵌图片是否值得推理，返回跳过原因，需要推理时返回 None"""
+    if width <= 0 or height <= 0 or width * height < IMAGE_MIN_PIXELS:
+        return 'small'
+    if max(width, height) / min(width, height) > IMAGE_MAX_ASPECT_RATIO:
+        return 'aspect'
+    return None
+
+def _count_prefilter(reason):
+    with _prefilter_lock:
+        _prefilter_counters['checked'] += 1
+        if reason:
+            _prefilter_counters[reason] += 1
+
+def prefilter_stats():
+    """预过滤检查和跳过的累计计数"""
+    with _prefilter_lock:
+        stats = dict(_prefilter_counters)
+    stats['skipped'] = stats['small'] + stats['aspect'] + stats['mask']
+    return stats
+
+# 视频帧去重统计，供 /stats 使用
+_video_counters = {'frames_scored': 0, 'frames_skipped': 0}
+_video_counters_lock = threading.Lock()
+
+def video_stats():
+    """视频帧推理与近似重复跳过的累计计数"""
+    with _video_counters_lock:
+        return dict(_video_counters)
 
 class VideoProcessor:
-    def __init__(self, video_path):
+    # 去重后补充采样的最大轮数
+    REFILL_ROUNDS = 2
+    # 设置了外部取消事件时，等待帧结果期间检查取消的间隔
+    CANCEL_POLL_SECONDS = 0.2
+
+    def __init__(self, video_path, check_all=CHECK_ALL_FILES, cancel=None):
+        """
+        Args:
+            video_path: 视频文件路径
+            check_all: 为真时检测所有采样帧并返回时间线，不在第一次命中时停止
+            cancel: 可选的 threading.Event，被设置后终止 ffmpeg 并返回已有结果
+        """
         self.video_path = video_path
-        self.temp_dir = None
+        self.check_all = bool(check_all)
+        self.cancel = cancel
+        self._ffmpeg = set()  # 当前正在输出帧的 ffmpeg 进程
+        self._ffmpeg_lock = threading.Lock()
+        self._stopped = threading.Event()
         self.duration = None
         self.frame_rate = None
         self.total_frames = None
 
-    def _get_video_info(self):
-        """获取视频基本信息"""
-        try:
-            # 使用 ffprobe 而不是 ffmpeg
-            duration_cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-show_entries', 'format=duration',
-                '-show_entries', 'stream=r_frame_rate',
-                '-select_streams', 'v',
-                '-of', 'json',
-                self.video_path
-            ]
-
-            result = subprocess.run(
-                duration_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=FFMPEG_TIMEOUT
-            )
+    def _ffprobe(self, *args):
+        """运行 ffprobe 并解析 JSON 输出"""
+        probe_cmd = ['ffprobe', '-v', 'error', *args, '-of', 'json', self.video_path]
+        result = subprocess.run(
+            probe_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=FFMPEG_TIMEOUT
+        )
+        if result.returncode != 0:
+            raise Exception(f"Failed to get video info: {result.stderr.decode()}")
+        return json.loads(result.stdout.decode() or '{}')
 
-            if result.returncode != 0:
-                raise Exception(f"Failed to get video info: {result.stderr.decode()}")
+    def _probe_duration(self, info, frame_rate):
+        """由低到高代价依次估算时长，全部失败时才完整解码视频
 
-            # 解析视频信息
-            import json
-            info = json.loads(result.stdout.decode())
-            
-            # 获取时长
-            if 'format' in info and 'duration' in info['format']:
-                self.duration = float(info['format']['duration'])
+        1. 容器时长 format.duration
+        2. 视频流时长 stream.duration
+        3. 视频流帧数 nb_frames / 帧率
+        4. 只读取视频流数据包计数（不解码）/ 帧率
+        5. 码率 × 文件大小
+        6. ffmpeg 完整解码
+        """
+        fmt = info.get('format', {})
+        stream = (info.get('streams') or [{}])[0]
+
+        for source, value in (('format.duration', fmt.get('duration')),
+                              ('stream.duration', stream.get('duration'))):
+            duration = _parse_number(value)
+            if duration:
+                return duration, source
+
+        nb_frames = _parse_number(stream.get('nb_frames'))
+        if nb_frames and frame_rate:
+            return nb_frames / frame_rate, 'nb_frames'
+
+        if frame_rate:
+            try:
+                packets = self._ffprobe('-select_streams', 'v:0', '-count_packets',
+                                        '-show_entries', 'stream=nb_read_packets')
+                nb_packets = _parse_number((packets.get('streams') or [{}])[0].get('nb_read_packets'))
+                if nb_packets:
+                    return nb_packets / frame_rate, 'packets'
+            except Exception as e:
+                logger.warning(f"统计数据包失败: {str(e)}")
+
+        bit_rate = _parse_number(fmt.get('bit_rate'))
+        size = _parse_number(fmt.get('size')) or os.path.getsize(self.video_path)
+        if bit_rate and size:
+            return size * 8 / bit_rate, 'bitrate'
+
+        # 如果无法获取时长，使用替代命令
+        alt_duration_cmd = [
+            'ffmpeg',
+            '-i', self.video_path,
+            '-f', 'null',
+            '-'
+        ]
+        result = subprocess.run(
+            alt_duration_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=FFMPEG_TIMEOUT
+        )
+        # 从stderr中解析时长信息
+        duration_str = result.stderr.decode()
+        duration_match = re.search(r"Duration: (\d{2}):(\d{2}):(\d{2}.\d{2})", duration_str)
+        if duration_match:
+            hours, minutes, seconds = duration_match.groups()
+            return float(hours) * 3600 + float(minutes) * 60 + float(seconds), 'decode'
+        return 0, 'decode'
+
+    def _get_video_info(self):
+        """获取视频基本信息，结果按文件内容指纹缓存，重复的视频不会再次探测"""
+        try:
+            cache_key = make_key('video_info', file_fingerprint(self.video_path)) if result_cache.enabled else None
+            cached = result_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                self.duration = cached['duration']
+                self.frame_rate = cached['frame_rate']
+                source = 'cache'
             else:
-                # 如果无法获取时长，使用替代命令
-                alt_duration_cmd = [
-                    'ffmpeg',
-                    '-i', self.video_path,
-                    '-f', 'null',
-                    '-'
-                ]
-                result = subprocess.run(
-                    alt_duration_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=FFMPEG_TIMEOUT
+                # 一次 ffprobe 同时读取容器和视频流的元数据
+                info = self._ffprobe(
+                    '-select_streams', 'v:0',
+                    '-show_entries', 'format=duration,bit_rate,size:stream=duration,nb_frames,r_frame_rate,avg_frame_rate'
                 )
-                # 从stderr中解析时长信息
-                duration_str = result.stderr.decode()
-                import re
-                duration_match = re.search(r"Duration: (\d{2}):(\d{2}):(\d{2}.\d{2})", duration_str)
-                if duration_match:
-                    hours, minutes, seconds = duration_match.groups()
-                    self.duration = float(hours) * 3600 + float(minutes) * 60 + float(seconds)
-                else:
-                    self.duration = 0
-            
-            # 获取帧率
-            if 'streams' in info and info['streams'] and 'r_frame_rate' in info['streams'][0]:
-                fr_str = info['streams'][0]['r_frame_rate']
-                if '/' in fr_str:
-                    fr_num, fr_den = map(int, fr_str.split('/'))
-                    self.frame_rate = fr_num / fr_den if fr_den != 0 else 0
-                else:
-                    self.frame_rate = float(fr_str)
-            else:
-                self.frame_rate = 25.0  # 默认帧率
-            
+
+                # 获取帧率
+                stream = (info.get('streams') or [{}])[0]
+                self.frame_rate = (_parse_rate(stream.get('r_frame_rate'))
+                                   or _parse_rate(stream.get('avg_frame_rate'))
+                                   or 25.0)  # 默认帧率
+
+                # 获取时长
+                self.duration, source = self._probe_duration(info, self.frame_rate)
+                if cache_key and self.duration:
+                    result_cache.set(cache_key, {'duration': self.duration, 'frame_rate': self.frame_rate})
+
             # 计算总帧数
             self.total_frames = int(self.duration * self.frame_rate) if self.duration and self.frame_rate else 0
-            
-            logger.info(f"视频信息: 时长={self.duration:.2f}秒, "
+
+            logger.info(f"视频信息: 时长={self.duration:.2f}秒 (来源: {source}), "
                        f"帧率={self.frame_rate:.2f}fps, "
                        f"总帧数={self.total_frames}")
-                       
+
         except subprocess.TimeoutExpired:
             raise Exception("获取视频信息超时")
         except Exception as e:
             raise Exception(f"获取视频信息失败: {str(e)}")
 
-    def _extract_keyframes(self):
-        """提取视频帧，使用固定帧率策略"""
+    def _sampling_plan(self):
+        """根据视频时长计算采样帧率，返回 (fps, 计划提取帧数, 采样间隔秒数)"""
+        if not self.duration:
+            raise ValueError("视频信息不完整，请先调用 _get_video_info()")
+
+        # 计算采样帧率，添加安全检查
+        if self.duration < FFMPEG_MAX_FRAMES:
+            # 如果视频时长小于预期提取的帧数，则每秒提取一帧
+            fps = "1"
+            interval_seconds = 1
+            frames_to_extract = max(1, min(int(self.duration), FFMPEG_MAX_FRAMES))
+        else:
+            # 正常情况下的帧率计算
+            interval_seconds = max(1, int(self.duration / FFMPEG_MAX_FRAMES))
+            fps = f"1/{interval_seconds}"
+            frames_to_extract = FFMPEG_MAX_FRAMES
+        return fps, frames_to_extract, interval_seconds
+
+    def _scale_filter(self, video_filter=None):
+        """在给定滤镜后追加缩放到模型输入尺寸的 scale 滤镜"""
+        width, height = preprocessor.size
+        scale = f'scale={width}:{height}:flags=bilinear'
+        return f'{video_filter},{scale}' if video_filter else scale
+
+    def _spawn(self, command, **kwargs):
+        """启动 ffmpeg 并登记，停止时统一终止"""
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        with self._ffmpeg_lock:
+            self._ffmpeg.add(process)
+        if self._stopped.is_set():
+            process.kill()
+        return process
+
+    def _release(self, process):
+        with self._ffmpeg_lock:
+            self._ffmpeg.discard(process)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def _stream_frames(self, video_filter, frames_to_extract, interval_seconds, extra_args=()):
+        """启动 ffmpeg，把缩放到模型输入尺寸的 rgb24 原始帧写到标准输出
+
+        按固定字节数读取每一帧，直接得到 HxWx3 的 uint8 数组，
+        不经过临时目录，也没有 JPEG 编解码。
+
+        Yields:
+            (帧序号, 时间点, 像素数组)，帧序号从 1 开始
+        """
+        width, height = preprocessor.size
+        frame_bytes = width * height * 3
+        stream_cmd = [
+            'ffmpeg',
+            '-nostdin',
+            '-loglevel', 'error',
+            '-i', self.video_path,
+            *extra_args,
+            '-vf', self._scale_filter(video_filter),
+            '-frames:v', str(frames_to_extract),   # 限制提取帧数
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-'
+        ]
+
+        process = self._spawn(stream_cmd, bufsize=frame_bytes)
+        # 持续读取 stderr，避免管道写满导致 ffmpeg 阻塞
+        stderr_lines = []
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_lines.extend(process.stderr.read().decode(errors='replace').splitlines()[-20:]),
+            daemon=True
+        )
+        stderr_thread.start()
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            process.kill()
+
+        watchdog = threading.Timer(FFMPEG_TIMEOUT, on_timeout)
+        watchdog.start()
+
+        frame_num = 0
         try:
-            # 创建临时目录
-            self.temp_dir = tempfile.mkdtemp()
-            logger.info("开始提取视频帧...")
-            
-            if not self.duration:
-                raise ValueError("视频信息不完整，请先调用 _get_video_info()")
-                
-            # 计算采样帧率，添加安全检查
-            if self.duration < FFMPEG_MAX_FRAMES:
-                # 如果视频时长小于预期提取的帧数，则每秒提取一帧
-                fps = "1"
-                frames_to_extract = min(int(self.duration), FFMPEG_MAX_FRAMES)
-            else:
-                # 正常情况下的帧率计算
-                interval_seconds = max(1, int(self.duration / FFMPEG_MAX_FRAMES))
-                fps = f"1/{interval_seconds}"
-                frames_to_extract = FFMPEG_MAX_FRAMES
-                
-            logger.info(f"视频总长: {self.duration:.2f}秒, FPS: {fps}, 计划提取帧数: {frames_to_extract}")
-            
-            # 使用 fps filter 提取帧
-            extract_cmd = [
-                'ffmpeg',
-                '-i', self.video_path,
-                '-vf', f'fps={fps}',         # 使用固定帧率
-                '-frame_pts', '1',           # 输出时间戳
-                '-vframes', str(frames_to_extract),  # 限制提取帧数
-                '-q:v', '2',                 # 高质量（1-31，1最好）
-                '-y',                        # 覆盖已存在文件
-                os.path.join(self.temp_dir, 'frame-%d.jpg')
-            ]
-                
-            # 执行提取命令
-            result = subprocess.run(
-                extract_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=FFMPEG_TIMEOUT,
-                text=True
-            )
-            
-            if result.returncode != 0:
-                logger.error(f"提取帧失败，FFMPEG输出: {result.stderr}")
-                
-                # 如果第一次提取失败，尝试使用更保守的设置
-                conservative_cmd = [
-                    'ffmpeg',
-                    '-i', self.video_path,
-                    '-r', '1',               # 强制输出帧率为1fps
-                    '-vframes', str(frames_to_extract),
-                    '-q:v', '2',
-                    '-y',
-                    os.path.join(self.temp_dir, 'frame-%d.jpg')
-                ]
-                
-                logger.info("尝试使用备选提取方法...")
-                result = subprocess.run(
-                    conservative_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=FFMPEG_TIMEOUT,
-                    text=True
-                )
-                
-                if result.returncode != 0:
-                    raise Exception(f"提取帧失败（备选方法）: {result.stderr}")
-            
-            # 获取所有提取的帧文件并排序
-            frames = sorted(glob.glob(os.path.join(self.temp_dir, 'frame-*.jpg')))
-            extracted_count = len(frames)
-            
-            if extracted_count == 0:
-                raise Exception("未能提取到任何帧")
-            
-            if extracted_count < frames_to_extract:
-                logger.warning(f"实际提取帧数({extracted_count})小于计划帧数({frames_to_extract})")
-            
-            logger.info(f"成功提取 {extracted_count} 个帧")
-            return frames
-                
+            while True:
+                buffer = bytearray(frame_bytes)
+                view = memoryview(buffer)
+                filled = 0
+                while filled < frame_bytes:
+                    read = process.stdout.readinto(view[filled:])
+                    if not read:
+                        break
+                    filled += read
+                if filled < frame_bytes:
+                    break
+                frame_num += 1
+                yield (frame_num, (frame_num - 1) * interval_seconds,
+                       np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3))
+
+            process.wait()
+            stderr_thread.join(timeout=5)
+            if timed_out.is_set():
+                raise Exception(f"提取帧操作超时（超过 {FFMPEG_TIMEOUT} 秒）")
+            if process.returncode != 0 and frame_num == 0 and not self._stopped.is_set():
+                raise Exception(f"提取帧失败: {' '.join(stderr_lines)}")
+        finally:
+            # 提前结束（例如已发现匹配内容）时终止 ffmpeg
+            watchdog.cancel()
+            self._release(process)
+            process.stdout.close()
+
+    def _grab_frame(self, timestamp, keyframe_only=True):
+        """输入端 -ss 定位到指定时间点并读取一帧
+
+        Args:
+            keyframe_only: 只解码最近的一个关键帧；为 False 时从关键帧解码到精确时间点
+
+        Returns:
+            HxWx3 uint8 数组，该时间点之后没有可用帧时返回 None
+        """
+        width, height = preprocessor.size
+        seek_args = [
+            '-skip_frame', 'nokey',       # 只解码关键帧
+            '-noaccurate_seek',           # 直接输出定位到的关键帧，不再向后解码到精确时间点
+        ] if keyframe_only else []
+        grab_cmd = [
+            'ffmpeg',
+            '-nostdin',
+            '-loglevel', 'error',
+            *seek_args,
+            '-ss', f'{timestamp:.3f}',
+            '-i', self.video_path,
+            '-vf', self._scale_filter(),
+            '-frames:v', '1',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-'
+        ]
+        process = self._spawn(grab_cmd)
+        try:
+            stdout, stderr = process.communicate(timeout=FFMPEG_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            raise Exception(f"定位视频帧超时（超过 {FFMPEG_TIMEOUT} 秒）")
+        finally:
+            self._release(process)
+
+        if len(stdout) < width * height * 3:
+            if process.returncode != 0 and not self._stopped.is_set():
+                logger.warning(f"定位 {timestamp:.2f}秒 处的视频帧失败: {stderr.decode(errors='replace').strip()}")
+            return None
+        return np.frombuffer(stdout[:width * height * 3], dtype=np.uint8).reshape(height, width, 3)
+
+    def _seek_frames(self, timestamps, keyframe_only=True):
+        """由有限数量的 ffmpeg 进程并行定位各个时间点的帧
+
+        提取耗时只与采样帧数有关，与视频长度无关。
+
+        Yields:
+            (帧序号, 时间点, 像素数组)，按时间顺序
+        """
+        executor = ThreadPoolExecutor(max_workers=max(1, int(VIDEO_SEEK_WORKERS)),
+                                      thread_name_prefix='video-seek')
+        try:
+            futures = [executor.submit(self._grab_frame, timestamp, keyframe_only) for timestamp in timestamps]
+            for frame_num, (timestamp, future) in enumerate(zip(timestamps, futures), start=1):
+                if self._stopped.is_set():
+                    break
+                try:
+                    pixels = future.result()
+                except Exception as e:
+                    logger.error(f"处理帧 {frame_num} 失败: {str(e)}")
+                    continue
+                if pixels is not None:
+                    yield frame_num, timestamp, pixels
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _detect_scenes(self):
+        """用 ffmpeg 的场景切换分数在低分辨率下找出镜头切换点
+
+        Returns:
+            list: (时间点, 场景切换分数) 列表
+        """
+        detect_cmd = [
+            'ffmpeg',
+            '-nostdin',
+            '-loglevel', 'error',
+            '-i', self.video_path,
+            '-an', '-sn',
+            '-vf', f"scale=160:-2,select='gt(scene,{VIDEO_SCENE_THRESHOLD})',metadata=print:file=-",
+            '-f', 'null',
+            '-'
+        ]
+        process = self._spawn(detect_cmd)
+        try:
+            stdout, stderr = process.communicate(timeout=FFMPEG_TIMEOUT)
         except subprocess.TimeoutExpired:
-            logger.error("提取帧操作超时")
-            raise Exception(f"提取帧操作超时（超过 {FFMPEG_TIMEOUT} 秒）")
+            raise Exception(f"场景检测超时（超过 {FFMPEG_TIMEOUT} 秒）")
+        finally:
+            self._release(process)
+        if process.returncode != 0:
+            raise Exception(f"场景检测失败: {stderr.decode(errors='replace').strip()}")
+
+        scenes = []
+        timestamp = None
+        for line in stdout.decode(errors='replace').splitlines():
+            if 'pts_time:' in line:
+                timestamp = float(line.rsplit('pts_time:', 1)[1].split()[0])
+            elif line.startswith('lavfi.scene_score=') and timestamp is not None:
+                scenes.append((timestamp, float(line.split('=', 1)[1])))
+                timestamp = None
+        return scenes
+
+    def _sample_timestamps(self, frames_to_extract):
+        """seek 和 scene 模式下的采样时间点"""
+        if VIDEO_SAMPLING_MODE == 'scene':
+            start = time.monotonic()
+            scenes = self._detect_scenes()
+            timestamps = plan_scene_samples(self.duration, scenes, FFMPEG_MAX_FRAMES, MAX_INTERVAL_SECONDS)
+            logger.info(f"场景检测完成: 切换点={len(scenes)}, 采样帧数={len(timestamps)}, "
+                        f"耗时={time.monotonic() - start:.2f}秒")
+            return timestamps
+        return [self.duration * (index + 0.5) / frames_to_extract for index in range(frames_to_extract)]
+
+    def _extract_keyframes(self):
+        """提取视频帧
+
+        fps 模式以原始帧流方式按固定帧率采样；seek 模式按时长均匀取点并行定位关键帧；
+        scene 模式先检测镜头切换，把帧预算分配到切换点，并保证采样间隔不超过 MAX_INTERVAL_SECONDS。
+
+        Yields:
+            (帧序号, 时间点, 像素数组)
+        """
+        get_engine()
+        fps, frames_to_extract, interval_seconds = self._sampling_plan()
+        extracted_count = 0
+
+        if VIDEO_SAMPLING_MODE in ('seek', 'scene'):
+            try:
+                timestamps = self._sample_timestamps(frames_to_extract)
+                logger.info(f"视频总长: {self.duration:.2f}秒, 采样方式: {VIDEO_SAMPLING_MODE}, "
+                            f"定位采样帧数: {len(timestamps)}, 并行进程数: {VIDEO_SEEK_WORKERS}")
+                for frame in self._seek_frames(timestamps, keyframe_only=VIDEO_SAMPLING_MODE == 'seek'):
+                    extracted_count += 1
+                    yield frame
+            except Exception as e:
+                if extracted_count:
+                    raise
+                logger.error(f"{VIDEO_SAMPLING_MODE} 模式提取帧失败: {str(e)}")
+            if extracted_count or self._stopped.is_set():
+                logger.info(f"成功提取 {extracted_count} 个帧")
+                return
+            logger.warning("定位采样未得到任何帧，改用固定帧率提取")
+
+        logger.info(f"视频总长: {self.duration:.2f}秒, FPS: {fps}, 计划提取帧数: {frames_to_extract}")
+        try:
+            for frame in self._stream_frames(f'fps={fps}', frames_to_extract, interval_seconds):
+                extracted_count += 1
+                yield frame
         except Exception as e:
+            if extracted_count:
+                raise
             logger.error(f"提取帧失败: {str(e)}")
-            raise
-        finally:
-            # 注意：这里不要清理临时目录，因为返回的帧路径还需要被使用
-            # 清理工作应该在帧处理完成后进行
-            pass
-    
-    def _process_frame(self, frame_path):
-        """处理单个帧"""
+            # 如果第一次提取失败，尝试使用更保守的设置（强制输出帧率为1fps）
+            logger.info("尝试使用备选提取方法...")
+            for frame in self._stream_frames(None, frames_to_extract, 1, extra_args=('-r', '1')):
+                extracted_count += 1
+                yield frame
+
+        if self._stopped.is_set():
+            logger.info(f"已提前终止帧提取，共提取 {extracted_count} 个帧")
+            return
+        if extracted_count == 0:
+            raise Exception("未能提取到任何帧")
+        if extracted_count < frames_to_extract:
+            logger.warning(f"实际提取帧数({extracted_count})小于计划帧数({frames_to_extract})")
+        logger.info(f"成功提取 {extracted_count} 个帧")
+
+    def _produce(self, pending):
+        """生产者：边解码边把帧提交到批处理调度器，提交结果按帧顺序放入队列
+
+        与本视频中已提交帧近似重复的帧不再推理，直接复用其分数；
+        跳过的帧数作为预算，在最大的采样空隙中补充新的时间点。
+        """
+        signatures = BKTree()
+        sampled = []
+        frame_num = 0
+
+        def submit(frames):
+            nonlocal frame_num
+            skipped = 0
+            try:
+                for _, timestamp, pixels in frames:
+                    if self._stopped.is_set():
+                        break
+                    frame_num += 1
+                    sampled.append(timestamp)
+                    signature = dhash(pixels) if VIDEO_FRAME_DEDUP_DISTANCE > 0 else None
+                    if signature is not None and signature not in DEGENERATE_HASHES:
+                        match = signatures.find(signature, VIDEO_FRAME_DEDUP_DISTANCE)
+                        if match is not None:
+                            pending.put((frame_num, timestamp, None, match[1]))
+                            skipped += 1
+                            continue
+                    try:
+                        pending.put((frame_num, timestamp, _submit_pixels(pixels), None))
+                    except Exception as e:
+                        logger.error(f"处理帧 {frame_num} 失败: {str(e)}")
+                        continue
+                    if signature is not None and signature not in DEGENERATE_HASHES:
+                        signatures.add(signature, frame_num)
+            finally:
+                frames.close()
+            return skipped
+
         try:
-            with Image.open(frame_path) as img:
-                result = process_image(img)
-                frame_num = int(Path(frame_path).stem.split('-')[1])
-                return frame_num, result
+            skipped = submit(self._extract_keyframes())
+            for _ in range(self.REFILL_ROUNDS):
+                if not skipped or self._stopped.is_set():
+                    break
+                timestamps = refill_timestamps(self.duration, sampled, skipped)
+                logger.info(f"跳过 {skipped} 个近似重复帧，补充采样 {len(timestamps)} 个时间点")
+                skipped = submit(self._seek_frames(timestamps, keyframe_only=False))
         except Exception as e:
-            logger.error(f"处理帧 {frame_path} 失败: {str(e)}")
-            return None, None
+            pending.put(e)
+        finally:
+            pending.put(None)
+
+    def _timeline_result(self, scores, timeline, inspected, skipped):
+        """汇总所有采样帧的分数：以分数最高的帧作为结论，附带时间线和统计"""
+        timeline.sort()
+        values = [nsfw for _, nsfw in timeline]
+        result = dict(max(scores.values(), key=lambda item: item['nsfw']))
+        result.update({
+            'inspected_timestamps': sorted(inspected),
+            'skipped_frames': skipped,
+            'timeline': [[round(timestamp, 3), round(nsfw, 4)] for timestamp, nsfw in timeline],
+            'timeline_stats': {
+                'frames': len(values),
+                'max': round(max(values), 4),
+                'mean': round(sum(values) / len(values), 4),
+                'over_threshold': round(sum(value > NSFW_THRESHOLD for value in values) / len(values), 4)
+            }
+        })
+        logger.info(f"视频时间线检测完成: 帧数={len(values)}, 最高分={result['nsfw']:.3f}, "
+                    f"超过阈值比例={result['timeline_stats']['over_threshold']:.2%}")
+        return result
+
+    def _stop(self, pending):
+        """停止解码：终止 ffmpeg，并取消尚未开始推理的帧"""
+        self._stopped.set()
+        with self._ffmpeg_lock:
+            processes = list(self._ffmpeg)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple) and item[2] is not None and item[2][1] is not None:
+                item[2][1][0].cancel()
+
+    def _next_item(self, pending):
+        """从队列取下一项，外部取消时返回 None"""
+        if self.cancel is None:
+            return pending.get()
+        while not self.cancel.is_set():
+            try:
+                return pending.get(timeout=self.CANCEL_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        logger.info("视频处理已取消")
+        return None
 
     def process(self):
-        """按顺序处理视频文件"""
+        """流水线处理视频文件：解码和推理同时进行，发现匹配内容后立即终止 ffmpeg
+
+        返回结果中的 inspected_timestamps 为实际检测过的帧时间点（秒）。
+        check_all 模式下检测全部采样帧，返回分数最高的帧以及时间线和汇总统计。
+        """
+        start = time.monotonic()
+        # 获取视频信息
+        self._get_video_info()
+
+        logger.info("开始提取视频帧...")
+        pending = queue.Queue()
+        producer = threading.Thread(target=self._produce, args=(pending,),
+                                    name='video-decoder', daemon=True)
+        producer.start()
+
+        last_result = None
+        inspected = []
+        scores = {}
+        timeline = []
+        skipped = 0
         try:
-            # 获取视频信息
-            self._get_video_info()
-            
-            # 提取关键帧
-            frame_files = self._extract_keyframes()
-            if not frame_files:
-                logger.warning("未能提取到任何关键帧")
-                return None
-            
-            # 按顺序处理帧
-            last_result = None
-            for frame in sorted(frame_files):
-                frame_num, result = self._process_frame(frame)
-                if result is not None:
-                    last_result = result
-                    if result['nsfw'] > NSFW_THRESHOLD:
-                        logger.info(f"在帧 {frame_num} 发现匹配内容")
-                        return result
-            
+            # 按帧顺序收集结果
+            while True:
+                item = self._next_item(pending)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                frame_num, timestamp, submission, duplicate_of = item
+                if duplicate_of is not None:
+                    # 近似重复帧复用之前的分数，之前的帧未达到阈值，这里也不会
+                    skipped += 1
+                    if duplicate_of in scores:
+                        timeline.append((timestamp, scores[duplicate_of]['nsfw']))
+                    logger.debug(f"帧 {frame_num} 与帧 {duplicate_of} 近似重复，跳过推理")
+                    if last_result is not None:
+                        last_result['skipped_frames'] = skipped
+                    continue
+                result, submitted = submission
+                try:
+                    if submitted is not None:
+                        result = _collect_image(submitted)
+                except Exception as e:
+                    logger.error(f"处理帧 {frame_num} 失败: {str(e)}")
+                    continue
+                scores[frame_num] = result
+                timeline.append((timestamp, result['nsfw']))
+                inspected.append(round(timestamp, 3))
+                last_result = dict(result, inspected_timestamps=inspected, skipped_frames=skipped)
+                if self.check_all:
+                    continue
+                if result['nsfw'] > NSFW_THRESHOLD:
+                    logger.info(f"在帧 {frame_num}（{timestamp:.2f}秒）发现匹配内容，"
+                                f"耗时 {time.monotonic() - start:.2f}秒")
+                    return last_result
+
+            if self.check_all and scores:
+                return self._timeline_result(scores, timeline, inspected, skipped)
             return last_result
-            
+
         except Exception as e:
             logger.error(f"处理视频失败: {str(e)}")
             raise
-            
+
         finally:
-            # 清理临时文件
-            if self.temp_dir and os.path.exists(self.temp_dir):
-                try:
-                    shutil.rmtree(self.temp_dir)
-                    logger.info("清理临时文件完成")
-                except Exception as e:
-                    logger.error(f"清理临时文件失败: {str(e)}")
+            self._stop(pending)
+            producer.join(timeout=5)
+            self._stop(pending)
+            with _video_counters_lock:
+                _video_counters['frames_scored'] += len(scores)
+                _video_counters['frames_skipped'] += skipped
+
+def _submit_image(image, data=None):
+    """查询缓存和感知哈希索引，未命中时提交到批处理调度器
+
+    Returns:
+        (结果, None) 命中缓存时；(None, (Future, 缓存键, 感知哈希)) 需要推理时
+    """
+    cache_key = make_key('image', sha256_bytes(data)) if result_cache.enabled and data is not None else None
+    if cache_key:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"图片命中缓存: NSFW={cached['nsfw']:.3f}, Normal={cached['normal']:.3f}")
+            return cached, None
+
+    # 缩小解码并缩放到模型输入尺寸，后续的哈希和推理都基于该像素
+    get_engine()
+    return _submit_pixels(preprocessor.load(image), cache_key)
 
-def process_image(image):
-    """处理单张图片并返回检测结果"""
+def _submit_pixels(pixels, cache_key=None):
+    """对已缩放到模型输入尺寸的 HxWx3 uint8 数组查询缓存和感知哈希索引，未命中时提交推理"""
+    if result_cache.enabled and cache_key is None:
+        cache_key = make_key('pixels', sha256_bytes(pixels.tobytes()))
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"图片命中缓存: NSFW={cached['nsfw']:.3f}, Normal={cached['normal']:.3f}")
+            return cached, None
+
+    # 近似重复检测：重新编码、缩放或去除元数据后的图片复用已有结果
+    image_hash = dhash(pixels) if phash_index.enabled else None
+    if image_hash is not None:
+        similar = phash_index.lookup(image_hash)
+        if similar is not None:
+            if cache_key:
+                result_cache.set(cache_key, similar)
+            return similar, None
+
+    if prescreen_preprocessor is not None:
+        return None, (_submit_cascade(pixels), cache_key, image_hash)
+    return None, (scheduler.submit(pixels), cache_key, image_hash)
+
+def _collect_image(pending):
+    """等待推理结果并写入缓存和感知哈希索引"""
+    future, cache_key, image_hash = pending
+    result = future.result()
+    stage = f", 阶段={result['stage']}" if 'stage' in result else ''
+    logger.info(f"图片处理完成: NSFW={result['nsfw']:.3f}, Normal={result['normal']:.3f}{stage}")
+    if cache_key:
+        result_cache.set(cache_key, result)
+    if image_hash is not None:
+        phash_index.add(image_hash, result)
+    return result
+
+def process_image(image, data=None):
+    """处理单张图片并返回检测结果
+
+    Args:
+        image: PIL 图片对象
+        data: 图片的原始字节（可选），提供时用于计算缓存键
+    """
     try:
         logger.info("开始处理图片")
-        result = pipe(image)
-        nsfw_score = next((item['score'] for item in result if item['label'] == 'nsfw'), 0)
-        normal_score = next((item['score'] for item in result if item['label'] == 'normal'), 1)
-        logger.info(f"图片处理完成: NSFW={nsfw_score:.3f}, Normal={normal_score:.3f}")
-        return {
-            'nsfw': nsfw_score,
-            'normal': normal_score
-        }
+        result, pending = _submit_image(image, data)
+        return result if pending is None else _collect_image(pending)
     except Exception as e:
         logger.error(f"图片处理失败: {str(e)}")
         raise Exception(f"Image processing failed: {str(e)}")
 
-def process_pdf_file(pdf_stream):
-    """处理PDF文件并检查内容"""
+def sample_pages(pages, budget):
+    """在候选页中均匀抽取最多 budget 页，首页和末页总是保留"""
+    pages = list(pages)
+    if budget <= 0 or len(pages) <= budget:
+        return pages
+    if budget == 1:
+        return pages[:1]
+    step = (len(pages) - 1) / (budget - 1)
+    return [pages[round(index * step)] for index in range(budget)]
+
+def _open_pdf(pdf_source):
+    import fitz  # 延迟导入，只有处理 PDF 时才加载 PyMuPDF
+    if isinstance(pdf_source, (str, os.PathLike)):
+        return fitz.open(pdf_source, filetype="pdf")
+    return fitz.open(stream=pdf_source, filetype="pdf")
+
+def _render_pages(pdf_source, page_numbers, size):
+    """把指定页面直接渲染为模型输入尺寸的 RGB 像素，在渲染进程或渲染线程中执行
+
+    Args:
+        page_numbers: 从 0 开始的页码列表
+        size: 模型输入尺寸 (宽, 高)
+
+    Returns:
+        [(页码, HxWx3 uint8 数组)]
+    """
+    import fitz
+    width, height = size
+    doc = _open_pdf(pdf_source)
     try:
-        logger.info("开始处理PDF文件")
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-        total_pages = len(doc)
-        logger.info(f"PDF共有 {total_pages} 页")
-        
-        last_result = None  # 保存最后一次处理结果
-        
-        for page_num in range(total_pages):
-            logger.info(f"正在处理第 {page_num + 1} 页")
+        rendered = []
+        for page_num in page_numbers:
             page = doc[page_num]
-            image_list = page.get_images()
-            
-            if len(image_list) > 0:
-                logger.info(f"第 {page_num + 1} 页发现 {len(image_list)} 张图片")
-            
-            for img_index, img in enumerate(image_list):
+            # 横纵方向分别缩放，渲染结果就是模型输入尺寸，不需要编码成 PNG 再解码缩放
+            matrix = fitz.Matrix(width / page.rect.width, height / page.rect.height)
+            pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csRGB, alpha=False)
+            pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+            pixels = pixels[:, :pix.width * 3].reshape(pix.height, pix.width, 3)
+            if pixels.shape[:2] != (height, width):
+                # 页面尺寸取整后可能相差一个像素
+                pixels = np.asarray(Image.fromarray(pixels).resize((width, height), Image.BILINEAR))
+            rendered.append((page_num, np.ascontiguousarray(pixels)))
+        return rendered
+    finally:
+        doc.close()
+
+# 页面渲染进程池，首次并行渲染时创建
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    """MuPDF 不能在多个线程中同时渲染，并行渲染使用独立进程，每个进程打开自己的文档"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _render_pool
+
+def _discard_render_pool(pool):
+    """渲染进程异常退出（例如损坏的 PDF 导致崩溃）后丢弃进程池，下次使用时重建"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+class PdfProcessor:
+    """PDF 图片扫描
+
+    先收集整个文档中去重后的图片 xref（同一张图片被多页引用时只处理一次），
+    在线程池中提取和解码，并提交到批处理调度器合批推理。
+    命中时返回引用该图片的所有页码。
+    内嵌图片都未命中时，按 render_mode 把页面直接渲染成模型输入尺寸再检测，
+    覆盖内联图片、矢量图和被切成碎片的图片。
+    """
+    RENDER_CHUNK = 8  # 每个渲染任务包含的页数
+    # fallback 模式下，非文字绘制操作至少覆盖页面面积的该比例时才渲染
+    GRAPHIC_COVERAGE = 0.05
+    GRAPHIC_KINDS = ('fill-path', 'stroke-path', 'fill-image', 'fill-imgmask', 'fill-shade')
+
+    def __init__(self, pdf_source, workers=PDF_WORKERS, render_mode=PDF_RENDER_MODE,
+                 max_render_pages=PDF_RENDER_MAX_PAGES, cancel=None):
+        """
+        Args:
+            pdf_source: PDF 文件路径或字节内容；传入路径时由 MuPDF 按需从磁盘读取，
+                内存占用只与最大的单张图片有关，与文件大小无关
+            render_mode: off / fallback / all，见 PDF_RENDER_MODE
+            max_render_pages: 最多渲染的页数
+            cancel: 可选的 threading.Event，被设置后不再提交新的图片和页面
+        """
+        self.pdf_source = pdf_source
+        self.workers = max(1, int(workers))
+        self.render_mode = render_mode
+        self.max_render_pages = int(max_render_pages)
+        self.cancel = cancel
+        self.doc = None
+        # MuPDF 的文档对象不是线程安全的，提取原始数据时串行访问
+        self._doc_lock = threading.Lock()
+
+    def _collect_xrefs(self):
+        """返回 {xref: [页码, ...]}，按首次出现的页顺序排列
+
+        只读取图片字典中的宽高和掩码信息，不解码图片：
+        过小、长宽比过大的图片，以及作为 SMask 或模板掩码的图片不参与推理。
+        """
+        xref_pages = {}
+        metadata = {}
+        smasks = set()
+        for page_num in range(len(self.doc)):
+            for img in self.doc.get_page_images(page_num, full=True):
+                xref, smask, width, height = img[0], img[1], img[2], img[3]
+                metadata[xref] = (width, height)
+                if smask:
+                    smasks.add(smask)
+                pages = xref_pages.setdefault(xref, [])
+                if not pages or pages[-1] != page_num + 1:
+                    pages.append(page_num + 1)
+
+        skipped = {}
+        for xref in list(xref_pages):
+            if xref in smasks or self.doc.xref_get_key(xref, 'ImageMask')[1] == 'true':
+                reason = 'mask'
+            else:
+                reason = prefilter_reason(*metadata[xref])
+            _count_prefilter(reason)
+            if reason:
+                skipped[reason] = skipped.get(reason, 0) + 1
+                del xref_pages[xref]
+        if skipped:
+            logger.info(f"预过滤跳过 {sum(skipped.values())} 张图片: {skipped}")
+        return xref_pages
+
+    def _extract_and_submit(self, xref):
+        """提取并解码一张图片，查询缓存后提交推理"""
+        with self._doc_lock:
+            base_image = self.doc.extract_image(xref)
+        image_bytes = base_image["image"]
+        image = Image.open(io.BytesIO(image_bytes))
+        return _submit_image(image, image_bytes)
+
+    def _cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def _has_graphics(self, page):
+        """根据绘制操作的边界框判断页面是否含有图形内容，不需要渲染页面"""
+        import fitz
+        area = abs(page.rect)
+        covered = 0.0
+        for kind, bbox in page.get_bboxlog():
+            if kind in self.GRAPHIC_KINDS:
+                covered += abs(fitz.Rect(bbox) & page.rect)
+        return area > 0 and covered / area >= self.GRAPHIC_COVERAGE
+
+    def _render_candidates(self, xref_pages):
+        """返回需要渲染的候选页和按页数上限抽样后的页码（从 0 开始）"""
+        if self.render_mode == 'all':
+            candidates = list(range(len(self.doc)))
+        else:
+            # 已有可检测图片的页面不再渲染
+            covered = {page - 1 for pages in xref_pages.values() for page in pages}
+            candidates = [page_num for page_num in range(len(self.doc))
+                          if page_num not in covered and self._has_graphics(self.doc[page_num])]
+        return candidates, sample_pages(candidates, self.max_render_pages)
+
+    def _scan_pages(self, xref_pages):
+        """渲染页面并检测，命中时返回带 pages 的结果，否则返回最后一次结果"""
+        with self._doc_lock:
+            candidates, selected = self._render_candidates(xref_pages)
+        if not selected:
+            return None
+        logger.info(f"渲染 {len(selected)} 页进行检测（候选 {len(candidates)} 页，方式: {self.render_mode}）")
+
+        get_engine()
+        size = preprocessor.size
+        chunks = [selected[start:start + self.RENDER_CHUNK]
+                  for start in range(0, len(selected), self.RENDER_CHUNK)]
+        local = None
+        if self.workers > 1 and len(chunks) > 1:
+            executor = _get_render_pool()
+        else:
+            # 页数较少时在单个线程中渲染，省去启动渲染进程的开销
+            executor = local = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pdf-render')
+
+        last_result = None
+        pending_chunks = iter(chunks)
+        in_flight = deque()
+        try:
+            while not self._cancelled():
+                while len(in_flight) < self.workers * 2:
+                    chunk = next(pending_chunks, None)
+                    if chunk is None:
+                        break
+                    in_flight.append(executor.submit(_render_pages, self.pdf_source, chunk, size))
+                if not in_flight:
+                    break
+
                 try:
-                    xref = img[0]
-                    base_image = doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    
-                    image = Image.open(io.BytesIO(image_bytes))
-                    result = process_image(image)
-                    last_result = result  # 保存每次的处理结果
-                    
+                    rendered = in_flight.popleft().result()
+                except BrokenProcessPool as e:
+                    logger.error(f"PDF页面渲染进程异常退出: {str(e)}")
+                    _discard_render_pool(executor)
+                    break
+                except Exception as e:
+                    logger.error(f"渲染PDF页面失败: {str(e)}")
+                    continue
+
+                submitted = deque((page_num, _submit_pixels(pixels)) for page_num, pixels in rendered)
+                try:
+                    while submitted:
+                        page_num, (result, pending) = submitted.popleft()
+                        try:
+                            if pending is not None:
+                                result = _collect_image(pending)
+                        except Exception as e:
+                            logger.error(f"检测PDF第 {page_num + 1} 页失败: {str(e)}")
+                            continue
+                        last_result = result
+                        if result['nsfw'] > NSFW_THRESHOLD:
+                            logger.info(f"渲染第 {page_num + 1} 页发现匹配内容")
+                            return dict(result, pages=[page_num + 1])
+                finally:
+                    for _, (_, pending) in submitted:
+                        if pending is not None:
+                            pending[0].cancel()
+            return last_result
+        finally:
+            for future in in_flight:
+                future.cancel()
+            if local is not None:
+                local.shutdown(wait=True)
+
+    def process(self):
+        self.doc = _open_pdf(self.pdf_source)
+        try:
+            logger.info(f"PDF共有 {len(self.doc)} 页")
+            xref_pages = self._collect_xrefs()
+            references = sum(len(pages) for pages in xref_pages.values())
+            logger.info(f"PDF中共有 {len(xref_pages)} 张需要检测的不重复图片（{references} 处页面引用）")
+
+            last_result = None  # 保存最后一次处理结果
+            xrefs = iter(xref_pages)
+            in_flight = deque()
+            # 限制同时在处理中的图片数量，避免一次性把所有图片解码到内存
+            max_in_flight = self.workers * 2
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pdf-extract') as executor:
+                try:
+                    while not self._cancelled():
+                        while len(in_flight) < max_in_flight:
+                            xref = next(xrefs, None)
+                            if xref is None:
+                                break
+                            in_flight.append((xref, executor.submit(self._extract_and_submit, xref)))
+                        if not in_flight:
+                            break
+
+                        xref, future = in_flight.popleft()
+                        try:
+                            result, pending = future.result()
+                            if pending is not None:
+                                result = _collect_image(pending)
+                        except Exception as e:
+                            logger.error(f"处理PDF中的图片失败: {str(e)}")
+                            continue
+
+                        last_result = result
+                        if result['nsfw'] > NSFW_THRESHOLD:
+                            pages = xref_pages[xref]
+                            shown = ', '.join(map(str, pages[:10])) + (' ...' if len(pages) > 10 else '')
+                            logger.info(f"在第 {shown} 页发现匹配内容（共 {len(pages)} 页引用该图片）")
+                            return dict(result, pages=pages)
+                finally:
+                    for _, future in in_flight:
+                        future.cancel()
+
+            if self.render_mode in ('fallback', 'all') and not self._cancelled():
+                result = self._scan_pages(xref_pages)
+                if result is not None:
+                    last_result = result
                     if result['nsfw'] > NSFW_THRESHOLD:
-                        logger.info(f"在第 {page_num + 1} 页发现匹配内容")
                         return result
 
-                except Exception as e:
-                    logger.error(f"处理PDF中的图片失败: {str(e)}")
-                    continue
-        
-        logger.info("PDF处理完成，返回最后一次处理结果")
-        return last_result  # 返回最后一次处理结果，如果没有处理过任何图片则为None
+            logger.info("PDF处理完成，返回最后一次处理结果")
+            return last_result  # 返回最后一次处理结果，如果没有处理过任何图片则为None
+        finally:
+            with self._doc_lock:
+                self.doc.close()
+
+def process_pdf_file(pdf_source, cancel=None):
+    """处理PDF文件并检查内容
+
+    Args:
+        pdf_source: PDF 文件路径（推荐，不会整体读入内存）或字节内容
+        cancel: 可选的 threading.Event，被设置后尽快停止
+    """
+    try:
+        logger.info("开始处理PDF文件")
+        return PdfProcessor(pdf_source, cancel=cancel).process()
     except Exception as e:
         logger.error(f"PDF处理失败: {str(e)}")
         raise Exception(f"PDF processing failed: {str(e)}")
 
-def process_video_file(video_path):
-    """处理视频文件的入口函数"""
-    processor = VideoProcessor(video_path)
+def process_video_file(video_path, check_all=CHECK_ALL_FILES, cancel=None):
+    """处理视频文件的入口函数
+
+    Args:
+        check_all: 为真时检测所有采样帧并返回时间线
+        cancel: 可选的 threading.Event，被设置后终止 ffmpeg 并尽快返回
+    """
+    processor = VideoProcessor(video_path, check_all, cancel)
     return processor.process()
 
-def process_archive(filepath, filename, depth=0, max_depth=100):
+def _scan_image_content(inner_filename, content):
+    """检测压缩包中图片成员的内容，预过滤跳过时返回 None"""
+    # Image.open 只解析文件头，尺寸不满足要求时不解码
+    img = Image.open(io.BytesIO(content))
+    reason = prefilter_reason(*img.size)
+    _count_prefilter(reason)
+    if reason:
+        logger.info(f"预过滤跳过图片 {inner_filename}: {reason}, 尺寸={img.size}")
+        return None
+    return process_image(img, content)
+
+def _scan_member(handler, inner_filename, cancel, check_all=CHECK_ALL_FILES):
+    """检测压缩包中的单个成员，在扫描线程中执行，没有结果时返回 None"""
+    if cancel.is_set():
+        return None
+    ext = os.path.splitext(inner_filename)[1].lower()
+
+    if ext in IMAGE_EXTENSIONS:
+        return _scan_image_content(inner_filename, handler.extract_file(inner_filename))
+
+    if ext == '.pdf':
+        # 成员流式写入磁盘后按路径打开，不整体读入内存
+        with handler.member_file(inner_filename, cancel) as member_path:
+            return process_pdf_file(member_path, cancel)
+
+    if ext in VIDEO_EXTENSIONS:
+        with handler.member_file(inner_filename, cancel) as member_path:
+            return process_video_file(member_path, check_all, cancel)
+    return None
+
+def scan_archive_members(handler, sorted_files, workers=ARCHIVE_WORKERS, check_all=CHECK_ALL_FILES):
+    """并行检测压缩包成员
+
+    成员按 sort_files_by_priority 的顺序提交到有界线程池，解压和解码并行进行，
+    图片在批处理调度器中与其它成员的图片合批推理。任一成员超过阈值后设置取消事件：
+    尚未开始的成员直接取消，正在进行的解压、PDF 扫描和 ffmpeg 解码尽快停止。
+
+    Returns:
+        (命中的 {'matched_file', 'result'} 或 None, 按优先级顺序最后一个有结果的成员)
+    """
+    cancel = threading.Event()
+    workers = max(1, int(workers))
+    members = iter(enumerate(sorted_files))
+    in_flight = {}
+    results = {}
+    matched_content = None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive-scan') as executor:
+        try:
+            while matched_content is None:
+                # 限制提交数量，保证优先级高的成员先开始，也避免一次性登记所有成员
+                while len(in_flight) < workers * 2:
+                    member = next(members, None)
+                    if member is None:
+                        break
+                    index, inner_filename = member
+                    future = executor.submit(_scan_member, handler, inner_filename, cancel, check_all)
+                    in_flight[future] = (index, inner_filename)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, inner_filename = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"处理文件 {inner_filename} 时出错: {str(e)}")
+                        continue
+                    if not result:
+                        continue
+                    results[index] = {'matched_file': inner_filename, 'result': result}
+                    if matched_content is None and result['nsfw'] > NSFW_THRESHOLD:
+                        matched_content = results[index]
+        finally:
+            cancel.set()
+            for future in in_flight:
+                future.cancel()
+
+    last_result = results[max(results)] if results else None
+    return matched_content, last_result
+
+def _scan_spooled_member(inner_filename, path, cancel, check_all=CHECK_ALL_FILES):
+    """检测从流式压缩包中复制到临时文件的 PDF 或视频成员，检测后删除临时文件"""
+    try:
+        if cancel.is_set():
+            return None
+        if inner_filename.lower().endswith('.pdf'):
+            return process_pdf_file(path, cancel)
+        return process_video_file(path, check_all, cancel)
+    finally:
+        os.unlink(path)
+
+def _scan_nested_buffer(inner_filename, buffer, depth, max_depth, check_all=CHECK_ALL_FILES):
+    """检测流式压缩包中的嵌套压缩包，返回检测结果，没有可用结果时返回 None"""
+    try:
+        nested_result = process_archive(buffer, inner_filename, depth, max_depth, check_all)
+    finally:
+        buffer.close()
+    if isinstance(nested_result, tuple) or nested_result.get('status') != 'success':
+        return None
+    return nested_result['result']
+
+def scan_stream_members(handler, depth=0, max_depth=100, workers=ARCHIVE_WORKERS, check_all=CHECK_ALL_FILES):
+    """顺序遍历 tar 类压缩包，成员经过时立即提交检测
+
+    流式压缩包不能随机访问，也就无法按优先级排序：主线程沿数据流读取成员，
+    图片读入内存，PDF、视频写入临时文件，然后交给有界线程池检测。
+    嵌套压缩包与 ZIP/RAR/7z 一样逐个处理：由读取线程缓冲后直接递归检测，
+    每一层同时只缓冲一个嵌套压缩包，内存和线程数不会随嵌套层数成倍增长。
+    同时处理中的成员数量有上限，内存和磁盘占用与压缩包大小无关；
+    任一成员超过阈值后停止读取数据流并取消其余成员。数据流损坏或被截断时停止读取，
+    仍返回已读取成员的结果。
+
+    Returns:
+        (命中的 {'matched_file', 'result'} 或 None, 最后一个有结果的成员)
+    """
+    cancel = threading.Event()
+    workers = max(1, int(workers))
+    in_flight = {}
+    results = {}
+    matched_content = None
+
+    def record(index, inner_filename, result):
+        nonlocal matched_content
+        if not result:
+            return
+        results[index] = {'matched_file': inner_filename, 'result': result}
+        if matched_content is None and result['nsfw'] > NSFW_THRESHOLD:
+            matched_content = results[index]
+
+    def collect(return_when, timeout=None):
+        done, _ = wait(in_flight, timeout=timeout, return_when=return_when)
+        for future in done:
+            index, inner_filename = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"处理文件 {inner_filename} 时出错: {str(e)}")
+                continue
+            record(index, inner_filename, result)
+
+    handler.ensure_temp_dir()
+    members = handler.iter_members()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive-scan') as executor:
+        try:
+            for index in itertools.count():
+                if matched_content is not None:
+                    break
+                try:
+                    member = next(members, None)
+                except Exception as e:
+                    # 数据流损坏或被截断：停止读取，已提交的成员照常收集结果
+                    logger.error(f"读取压缩包数据流时出错，停止读取后续成员: {str(e)}")
+                    break
+                if member is None:
+                    break
+                inner_filename, size, stream = member
+                ext = os.path.splitext(inner_filename)[1].lower()
+                try:
+                    if ext in IMAGE_EXTENSIONS:
+                        logger.info(f"正在检测文件: {os.path.basename(inner_filename)}")
+                        task = (_scan_image_content, inner_filename, stream.read())
+                    elif ext == '.pdf' or ext in VIDEO_EXTENSIONS:
+                        path = os.path.join(handler.temp_dir, f"{uuid.uuid4()}{ext}")
+                        with open(path, 'wb') as target:
+                            shutil.copyfileobj(stream, target, 1024 * 1024)
+                        task = (_scan_spooled_member, inner_filename, path, cancel, check_all)
+                    elif ext in ARCHIVE_EXTENSIONS:
+                        # 先收集已完成的成员，已经命中时不再展开嵌套压缩包
+                        if in_flight:
+                            collect(FIRST_COMPLETED, timeout=0)
+                        if matched_content is not None:
+                            break
+                        buffer = io.BytesIO()
+                        if size > NESTED_ARCHIVE_MEMORY_LIMIT:
+                            buffer = tempfile.TemporaryFile(dir=handler.temp_dir)
+                        try:
+                            shutil.copyfileobj(stream, buffer, 1024 * 1024)
+                        except Exception:
+                            buffer.close()
+                            raise
+                        buffer.seek(0)
+                        record(index, inner_filename, _scan_nested_buffer(
+                            inner_filename, buffer, depth + 1, max_depth, check_all
+                        ))
+                        continue
+                    else:
+                        continue
+                except Exception as e:
+                    logger.error(f"读取文件 {inner_filename} 时出错: {str(e)}")
+                    continue
+
+                # 等待空位时顺便收集已完成的结果，命中后不再读取后面的数据
+                while len(in_flight) >= workers * 2 and matched_content is None:
+                    collect(FIRST_COMPLETED)
+                if matched_content is not None:
+                    break
+                in_flight[executor.submit(*task)] = (index, inner_filename)
+
+            while in_flight and matched_content is None:
+                collect(FIRST_COMPLETED)
+        finally:
+            cancel.set()
+            members.close()
+            for future in in_flight:
+                future.cancel()
+
+    last_result = results[max(results)] if results else None
+    return matched_content, last_result
+
+def process_archive(filepath, filename, depth=0, max_depth=100, check_all=CHECK_ALL_FILES):
     """处理压缩文件，支持嵌套压缩包
     
     Args:
-        filepath: 压缩文件路径
+        filepath: 压缩文件路径，或嵌套压缩包在内存中的文件对象
         filename: 原始文件名
         depth: 当前递归深度
         max_depth: 最大递归深度，防止过深的嵌套
+        check_all: 为真时压缩包中的视频检测所有采样帧并返回时间线
     """
     temp_dir = None
     try:
@@ -342,17 +1498,55 @@ def process_archive(filepath, filename, depth=0, max_depth=100):
 
         # 创建临时目录
         temp_dir = tempfile.mkdtemp()
-        logger.info(f"处理压缩文件: {encoded_filename}, 深度: {depth}, 临时文件路径: {filepath}")
+        in_memory = not isinstance(filepath, (str, os.PathLike))
+        location = '内存' if in_memory else filepath
+        logger.info(f"处理压缩文件: {encoded_filename}, 深度: {depth}, 临时文件路径: {location}")
         
         # 检查文件大小
-        file_size = os.path.getsize(filepath)
+        if in_memory:
+            file_size = filepath.seek(0, os.SEEK_END)
+            filepath.seek(0)
+        else:
+            file_size = os.path.getsize(filepath)
         if file_size > MAX_FILE_SIZE:
             return {
                 'status': 'error',
                 'message': 'File too large'
             }, 400
 
-        with ArchiveHandler(filepath) as handler:
+        handler = ArchiveHandler(filepath, encoded_filename)
+        if in_memory and handler.type is None:
+            # 扩展名与内容不符（例如实际是 RAR），写入磁盘后交给外部工具识别
+            spill_path = os.path.join(temp_dir, f"nested{os.path.splitext(encoded_filename)[1]}")
+            filepath.seek(0)
+            with open(spill_path, 'wb') as target:
+                shutil.copyfileobj(filepath, target, 1024 * 1024)
+            handler = ArchiveHandler(spill_path, encoded_filename)
+
+        with handler:
+            if handler.type == 'tar':
+                matched_content, last_result = scan_stream_members(
+                    handler, depth, max_depth, check_all=check_all
+                )
+                if matched_content:
+                    logger.info(f"在压缩包 {encoded_filename} 中发现匹配内容: {matched_content['matched_file']}")
+                    return {
+                        'status': 'success',
+                        'filename': encoded_filename,
+                        'result': matched_content['result']
+                    }
+                if last_result:
+                    logger.info(f"处理压缩包 {encoded_filename} 完成，最后处理的文件: {last_result['matched_file']}")
+                    return {
+                        'status': 'success',
+                        'filename': encoded_filename,
+                        'result': last_result['result']
+                    }
+                return {
+                    'status': 'error',
+                    'message': 'No files could be processed successfully'
+                }, 400
+
             # 获取文件列表
             files = handler.list_files()
             
@@ -378,65 +1572,12 @@ def process_archive(filepath, filename, depth=0, max_depth=100):
                 }, 400
 
             # 先处理可直接处理的文件
+            last_result = None
             if processable_files:
                 sorted_files = sort_files_by_priority(handler, processable_files)
-                last_result = None
-                matched_content = None
-                
-                for inner_filename in sorted_files:
-                    try:
-                        # 确保内部文件名已正确编码
-                        if isinstance(inner_filename, bytes):
-                            inner_filename = handler.__encode_filename(inner_filename)
-                            
-                        content = handler.extract_file(inner_filename)
-                        ext = os.path.splitext(inner_filename)[1].lower()
-                        
-                        if ext in IMAGE_EXTENSIONS:
-                            img = Image.open(io.BytesIO(content))
-                            result = process_image(img)
-                            last_result = {
-                                'matched_file': inner_filename,
-                                'result': result
-                            }
-                            
-                            if result['nsfw'] > NSFW_THRESHOLD:
-                                matched_content = last_result
-                                break
-                        
-                        elif ext == '.pdf':
-                            result = process_pdf_file(content)
-                            if result:
-                                last_result = {
-                                    'matched_file': inner_filename,
-                                    'result': result
-                                }
-                                if result['nsfw'] > NSFW_THRESHOLD:
-                                    matched_content = last_result
-                                    break
-                        
-                        elif ext in VIDEO_EXTENSIONS:
-                            temp_video = tempfile.NamedTemporaryFile(delete=False, suffix=ext)
-                            try:
-                                with open(temp_video.name, 'wb') as f:
-                                    f.write(content)
-                                
-                                result = process_video_file(temp_video.name)
-                                if result:
-                                    last_result = {
-                                        'matched_file': inner_filename,
-                                        'result': result
-                                    }
-                                    if result['nsfw'] > NSFW_THRESHOLD:
-                                        matched_content = last_result
-                                        break
-                            finally:
-                                if os.path.exists(temp_video.name):
-                                    os.unlink(temp_video.name)
-                                    
-                    except Exception as e:
-                        logger.error(f"处理文件 {inner_filename} 时出错: {str(e)}")
-                        continue
+                matched_content, last_result = scan_archive_members(
+                    handler, sorted_files, check_all=check_all
+                )
 
                 if matched_content:
                     logger.info(f"在压缩包 {encoded_filename} 中发现匹配内容: {matched_content['matched_file']}")
@@ -453,19 +1594,27 @@ def process_archive(filepath, filename, depth=0, max_depth=100):
                     if isinstance(nested_archive, bytes):
                         nested_archive = handler.__encode_filename(nested_archive)
                         
-                    temp_nested = tempfile.NamedTemporaryFile(delete=False)
-                    content = handler.extract_file(nested_archive)
-                    
-                    with open(temp_nested.name, 'wb') as f:
-                        f.write(content)
-                    
-                    # 递归处理嵌套压缩包
-                    nested_result = process_archive(
-                        temp_nested.name,
-                        nested_archive,
-                        depth + 1,
-                        max_depth
-                    )
+                    nested_ext = os.path.splitext(nested_archive)[1].lower()
+                    if nested_ext in IN_MEMORY_ARCHIVE_EXTENSIONS:
+                        # ZIP、tar 和压缩流直接在内存中打开，较大时才转存到匿名临时文件
+                        with handler.member_buffer(nested_archive) as member_source:
+                            nested_result = process_archive(
+                                member_source,
+                                nested_archive,
+                                depth + 1,
+                                max_depth,
+                                check_all
+                            )
+                    else:
+                        # RAR/7z/cab 需要外部工具，流式写入磁盘后递归处理
+                        with handler.member_file(nested_archive) as member_path:
+                            nested_result = process_archive(
+                                member_path,
+                                nested_archive,
+                                depth + 1,
+                                max_depth,
+                                check_all
+                            )
                     
                     # 如果找到匹配内容，直接返回
                     if isinstance(nested_result, tuple):
@@ -478,9 +1627,6 @@ def process_archive(filepath, filename, depth=0, max_depth=100):
                 except Exception as e:
                     logger.error(f"处理嵌套压缩包 {nested_archive} 时出错: {str(e)}")
                     continue
-                finally:
-                    if os.path.exists(temp_nested.name):
-                        os.unlink(temp_nested.name)
 
             # 如果所有文件都处理完还没有返回，返回最后一个结果
             if last_result:
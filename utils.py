@@ -1,164 +1,268 @@
 import zipfile
+import zlib
 import rarfile
 import gzip
+import bz2
+import lzma
+import tarfile
 import io
 import os
 import logging
+import threading
 import tempfile
 import subprocess
 import shutil
 import uuid
+from contextlib import contextmanager
+from concurrent.futures import CancelledError
 from pathlib import Path
-from config import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
+from config import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, NESTED_ARCHIVE_MEMORY_LIMIT
 
 logger = logging.getLogger(__name__)
 
+# 不需要外部工具、可以直接从内存中打开的嵌套压缩包格式
+IN_MEMORY_ARCHIVE_EXTENSIONS = {'.zip', '.gz', '.tar', '.bz2', '.xz', '.lzma', '.zst'}
+
+# 压缩流的文件头，(压缩方式, 魔数)；.lzma 是没有正式魔数的旧格式，按常见的属性字节识别
+COMPRESSION_MAGIC = [
+    ('gz', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zst', b'\x28\xb5\x2f\xfd'),
+    ('lzma', b'\x5d\x00\x00'),
+]
+
+def _is_tar_header(block):
+    """判断 512 字节的数据块是否是合法的 tar 文件头（校验和正确）"""
+    if len(block) < tarfile.BLOCKSIZE:
+        return False
+    try:
+        tarfile.TarInfo.frombuf(block[:tarfile.BLOCKSIZE], tarfile.ENCODING, 'surrogateescape')
+        return True
+    except tarfile.HeaderError:
+        return False
+
 class ArchiveHandler:
-    def __init__(self, filepath):
+    def __init__(self, filepath, name=None):
+        """
+        Args:
+            filepath: 压缩文件路径，或可随机访问的二进制文件对象（只识别不需要外部工具的格式）
+            name: 压缩包的原始文件名，用于推断单文件压缩内容的文件名，默认取路径中的文件名
+        """
         self.filepath = filepath
+        self.in_memory = not isinstance(filepath, (str, os.PathLike))
+        self.name = name or ('content' if self.in_memory else os.path.basename(filepath))
         self.archive = None
+        self.compression = None  # tar 和单文件压缩的压缩方式: gz/bz2/xz/lzma/zst，未压缩为 None
+        self._7z_index = None  # 7z 成员索引，类型检测时生成
         self.type = self._determine_type()
         self.temp_dir = None
+        self._temp_dir_lock = threading.Lock()
         self._extracted_files = {}  # 存储解压文件的映射 {原始文件名: 临时文件路径}
         
     def _determine_type(self):
         try:
+            # tar 和压缩流按开头的文件头识别：必须在 ZIP 之前判断，因为 is_zipfile 在文件末尾
+            # 查找目录记录，末尾恰好是 ZIP 成员的 tar 也会被误判；也必须在 7z 之前，
+            # 否则会被 7z 当作单文件压缩包完整列出
+            stream_type = self._detect_stream_type()
+            if stream_type:
+                return stream_type
             if zipfile.is_zipfile(self.filepath):
                 return 'zip'
+            if self.in_memory:
+                # RAR 和 7z 需要外部工具读取磁盘文件，内存中的数据由调用方写入磁盘后再识别
+                return None
             elif rarfile.is_rarfile(self.filepath):
                 return 'rar'
             elif self._is_7z_file(self.filepath):
+                # 包括 cab 等 7z 能够列出的其它格式
                 return '7z'
-            elif self._is_valid_gzip(self.filepath):
-                return 'gz'
             return None
         except Exception as e:
             logger.error(f"文件类型检测失败: {str(e)}")
             return None
+        finally:
+            # is_zipfile 等检测会把文件对象停在末尾，调用方还要从头读取
+            if self.in_memory:
+                self.filepath.seek(0)
+
+    def _read_header(self, size):
+        if self.in_memory:
+            self.filepath.seek(0)
+            header = self.filepath.read(size)
+            self.filepath.seek(0)
+            return header
+        with open(self.filepath, 'rb') as f:
+            return f.read(size)
+
+    def _detect_stream_type(self):
+        """识别 tar（可带 gz/bz2/xz/lzma/zst 压缩）和单文件压缩，返回 'tar'、'compressed' 或 None"""
+        header = self._read_header(tarfile.BLOCKSIZE)
+        compression = next((name for name, magic in COMPRESSION_MAGIC if header.startswith(magic)), None)
+        if compression is None:
+            return 'tar' if _is_tar_header(header) else None
+
+        self.compression = compression
+        try:
+            stream = self._open_stream()
+            try:
+                block = stream.read(tarfile.BLOCKSIZE)
+            finally:
+                stream.close()
+        except Exception as e:
+            logger.debug(f"{compression} 数据流检测失败: {str(e)}")
+            self.compression = None
+            return None
+        return 'tar' if _is_tar_header(block) else 'compressed'
+
+    def _open_stream(self):
+        """打开整个压缩包解压后的顺序读取流，调用方负责关闭"""
+        if self.in_memory:
+            self.filepath.seek(0)
+        if self.compression == 'gz':
+            return gzip.open(self.filepath, 'rb')
+        if self.compression == 'bz2':
+            return bz2.open(self.filepath, 'rb')
+        if self.compression in ('xz', 'lzma'):
+            return lzma.open(self.filepath, 'rb')
+        if self.compression == 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("处理 .zst 文件需要安装 zstandard")
+            if self.in_memory:
+                return zstandard.ZstdDecompressor().stream_reader(self.filepath, closefd=False)
+            return zstandard.ZstdDecompressor().stream_reader(open(self.filepath, 'rb'))
+        if self.in_memory:
+            # 未压缩的 tar 直接读取调用方的文件对象，关闭时不关闭调用方的数据
+            return _Unclosed(self.filepath)
+        return open(self.filepath, 'rb')
+
+    def iter_members(self):
+        """顺序遍历 tar 成员，依次产出 (文件名, 大小, 只读流)
+
+        以流模式读取，不随机访问也不整体解压，内存占用与压缩包大小无关。
+        产出的流只在下一次迭代之前有效，提前结束迭代时剩余数据不再解压。
+        """
+        stream = self._open_stream()
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as archive:
+                for info in archive:
+                    if info.isfile():
+                        yield info.name, info.size, archive.extractfile(info)
+        finally:
+            stream.close()
 
     def _is_7z_file(self, filepath):
+        """7z 能列出内容即视为 7z 格式，列表同时解析为成员索引，后续不再重复运行 7z l"""
+        return self._read_7z_index(filepath) is not None
+
+    def _read_7z_index(self, filepath):
+        """运行一次 7z l -slt，解析为 {路径: {'size', 'is_dir', 'crc'}}，无法列出时返回 None"""
+        if self._7z_index is not None:
+            return self._7z_index
         try:
             result = subprocess.run(
-                ['7z', 'l', filepath], 
-                stdout=subprocess.PIPE, 
+                ['7z', 'l', '-slt', filepath],
+                stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                encoding='utf-8'
+                encoding='utf-8',
+                errors='replace'
             )
-            return result.returncode == 0
         except Exception as e:
             logger.error(f"7z文件检测失败: {str(e)}")
-            return False
+            return None
+        if result.returncode != 0:
+            return None
 
-    def _is_valid_gzip(self, filepath):
-        try:
-            with gzip.open(filepath, 'rb') as f:
-                f.read(1)
-            return True
-        except Exception:
-            return False
+        index = {}
+        # 分隔线之前是压缩包本身的信息，之后每个成员一段，段之间以空行分隔
+        _, _, members = result.stdout.partition('\n----------\n')
+        for block in members.split('\n\n'):
+            fields = {}
+            for line in block.splitlines():
+                key, sep, value = line.partition(' = ')
+                if sep:
+                    fields[key.strip()] = value.strip()
+            path = fields.get('Path')
+            if not path:
+                continue
+            try:
+                size = int(fields.get('Size') or 0)
+            except ValueError:
+                size = 0
+            index[path] = {
+                'size': size,
+                'is_dir': fields.get('Folder') == '+' or fields.get('Attributes', '').startswith('D'),
+                'crc': fields.get('CRC', '')
+            }
+        self._7z_index = index
+        return index
+
+    def ensure_temp_dir(self):
+        """创建临时目录（只创建一次），多个扫描线程可能同时调用"""
+        with self._temp_dir_lock:
+            if not self.temp_dir:
+                self.temp_dir = tempfile.mkdtemp()
+            return self.temp_dir
 
     def _generate_temp_filename(self, original_filename):
         """生成唯一的临时文件名"""
         ext = Path(original_filename).suffix
         return f"{str(uuid.uuid4())}{ext}"
 
-    def _extract_rar_all(self):
-        """使用unrar命令行工具完整解压RAR文件"""
-        if not self.temp_dir:
-            self.temp_dir = tempfile.mkdtemp()
+    def _extract_7z_files(self, files_to_extract):
+        """用一次 7z x 调用把需要处理的成员解压到临时目录
 
+        成员名通过列表文件传入，-spd 关闭通配符匹配，保留目录结构避免同名文件互相覆盖。
+        """
+        files = [f for f in files_to_extract if f not in self._extracted_files]
+        if not files:
+            return
+        self.ensure_temp_dir()
+
+        output_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        list_path = os.path.join(self.temp_dir, f"{uuid.uuid4()}.lst")
         try:
-            # 使用unrar命令行工具解压
-            extract_cmd = ['unrar', 'x', '-y', self.filepath, self.temp_dir + os.sep]
+            with open(list_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(files))
             result = subprocess.run(
-                extract_cmd,
+                ['7z', 'x', '-y', '-spd', '-scsUTF-8', '-o' + output_dir, self.filepath, '@' + list_path],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                encoding='utf-8'
+                encoding='utf-8',
+                errors='replace'
             )
-
             if result.returncode != 0:
-                raise Exception(f"RAR解压失败: {result.stderr}")
+                logger.warning(f"7z解压部分文件失败: {result.stderr.strip()}")
 
-            # 遍历解压目录，重命名文件并记录映射关系
-            for root, _, files in os.walk(self.temp_dir):
-                for filename in files:
-                    original_path = os.path.join(root, filename)
-                    relative_path = os.path.relpath(original_path, self.temp_dir)
-                    
-                    # 生成新的唯一文件名
-                    new_filename = str(uuid.uuid4()) + os.path.splitext(filename)[1]
-                    new_path = os.path.join(self.temp_dir, new_filename)
-                    
-                    # 移动文件并记录映射
-                    os.rename(original_path, new_path)
-                    self._extracted_files[relative_path] = new_path
-
-            logger.info(f"成功解压 {len(self._extracted_files)} 个文件到临时目录")
-            return True
-
-        except Exception as e:
-            logger.error(f"RAR完整解压失败: {str(e)}")
-            return False
-        
-    def _extract_7z_files(self, files_to_extract):
-        """只解压需要处理的7z文件到临时目录"""
-        if not self.temp_dir:
-            self.temp_dir = tempfile.mkdtemp()
-
-        try:
-            for filename in files_to_extract:
-                # 为每个文件准备解压命令
-                extract_cmd = ['7z', 'e', self.filepath, '-o' + self.temp_dir, filename, '-y']
-                
-                # 执行解压
-                result = subprocess.run(
-                    extract_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    encoding='utf-8'
-                )
-                
-                if result.returncode != 0:
-                    logger.warning(f"解压文件 {filename} 失败: {result.stderr}")
+            root = os.path.realpath(output_dir)
+            for filename in files:
+                original_path = os.path.realpath(os.path.join(root, filename.lstrip('/\\')))
+                # 忽略解压目录之外的路径
+                if not original_path.startswith(root + os.sep) or not os.path.isfile(original_path):
+                    logger.warning(f"解压文件 {filename} 失败")
                     continue
-
-                # 获取解压后的文件路径
-                original_path = os.path.join(self.temp_dir, os.path.basename(filename))
-                if os.path.exists(original_path):
-                    new_filename = self._generate_temp_filename(filename)
-                    new_path = os.path.join(self.temp_dir, new_filename)
-                    try:
-                        # 尝试创建硬链接
-                        os.link(original_path, new_path)
-                    except OSError:
-                        # 如果硬链接失败，则复制文件
-                        shutil.copy2(original_path, new_path)
-                    self._extracted_files[filename] = new_path
-                    # 删除原始文件
-                    os.unlink(original_path)
-
-        except Exception as e:
-            logger.error(f"7z文件解压失败: {str(e)}")
-            if self.temp_dir and os.path.exists(self.temp_dir):
-                shutil.rmtree(self.temp_dir)
-            raise
+                new_path = os.path.join(self.temp_dir, self._generate_temp_filename(filename))
+                os.replace(original_path, new_path)
+                self._extracted_files[filename] = new_path
+            logger.info(f"7z批量解压 {len(self._extracted_files)}/{len(files)} 个文件")
+        finally:
+            if os.path.exists(list_path):
+                os.unlink(list_path)
+            shutil.rmtree(output_dir, ignore_errors=True)
 
     def __enter__(self):
         try:
             if self.type == 'zip':
+                # 只读取中央目录；成员在实际读取时才解压并校验 CRC，损坏只影响该成员
                 self.archive = zipfile.ZipFile(self.filepath)
-                if self.archive.testzip() is not None:
-                    raise zipfile.BadZipFile("ZIP文件损坏")
             elif self.type == 'rar':
+                # 只解析文件头；成员在扫描到时才通过 unrar p 流式解压
                 self.archive = rarfile.RarFile(self.filepath)
                 if self.archive.needs_password():
                     raise Exception("RAR文件有密码保护")
-                # 直接解压所有RAR文件
-                if not self._extract_rar_all():
-                    raise Exception("RAR文件解压失败")
-            elif self.type == 'gz':
-                self.archive = gzip.GzipFile(self.filepath)
             return self
         except (zipfile.BadZipFile, rarfile.BadRarFile) as e:
             raise Exception(f"无效的压缩文件: {str(e)}")
@@ -177,49 +281,29 @@ class ArchiveHandler:
     def list_files(self):
         try:
             if self.type == 'zip':
-                files = [f for f in self.archive.namelist() if not f.endswith('/')]
+                files = [info.filename for info in self.archive.infolist() if not info.is_dir()]
             elif self.type == 'rar':
-                # 对于RAR文件，直接返回已解压的文件列表
-                files = list(self._extracted_files.keys())
+                files = [info.filename for info in self.archive.infolist() if not info.is_dir()]
             elif self.type == '7z':
-                result = subprocess.run(
-                    ['7z', 'l', '-slt', self.filepath], 
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.PIPE,
-                    encoding='utf-8'
-                )
-                
-                if result.returncode != 0:
+                index = self._read_7z_index(self.filepath)
+                if index is None:
                     raise Exception("无法列出7z文件内容")
-                
-                files = []
-                current_file = None
-                is_directory = False
-                
-                for line in result.stdout.split('\n'):
-                    line = line.strip()
-                    if line.startswith('Path = '):
-                        current_file = line[7:]
-                    elif line.startswith('Attributes = D'):
-                        is_directory = True
-                    elif line == '':
-                        if current_file and not is_directory:
-                            files.append(current_file)
-                        current_file = None
-                        is_directory = False
-                
-                # 对于7z文件，只解压需要处理的文件
-                processable_files = [f for f in files if can_process_file(f)]
-                if processable_files:
-                    self._extract_7z_files(processable_files)
+                files = [name for name, member in index.items() if not member['is_dir']]
+
+                # 图片体积小且需要整体读取，一次 7z 调用批量解压；
+                # PDF 和视频在扫描到时才通过 7z x -so 流式读取，命中或取消后结束解压进程
+                image_files = [f for f in files if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+                if image_files:
+                    self._extract_7z_files(image_files)
                     
-            elif self.type == 'gz':
-                base_name = os.path.basename(self.filepath)
-                if base_name.endswith('.gz'):
-                    files = [base_name[:-3]]
+            elif self.type == 'compressed':
+                base_name, ext = os.path.splitext(self.name)
+                if ext.lower() in ('.gz', '.bz2', '.xz', '.lzma', '.zst'):
+                    files = [base_name]
                 else:
                     files = ['content']
             else:
+                # tar 只能顺序读取，通过 iter_members 遍历
                 files = []
 
             processable = [f for f in files if can_process_file(f)]
@@ -235,31 +319,10 @@ class ArchiveHandler:
             if self.type == 'zip':
                 return self.archive.getinfo(filename).file_size
             elif self.type == 'rar':
-                # 对于RAR文件，直接获取解压后文件的大小
-                if filename in self._extracted_files:
-                    return os.path.getsize(self._extracted_files[filename])
-                return 0
+                return self.archive.getinfo(filename).file_size
             elif self.type == '7z':
-                if filename in self._extracted_files:
-                    return os.path.getsize(self._extracted_files[filename])
-                # 如果文件未解压，运行7z l命令获取文件大小
-                result = subprocess.run(
-                    ['7z', 'l', '-slt', self.filepath, filename],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    encoding='utf-8'
-                )
-                
-                if result.returncode == 0:
-                    for line in result.stdout.split('\n'):
-                        if line.startswith('Size = '):
-                            try:
-                                return int(line[7:])
-                            except ValueError:
-                                pass
-                return 0
-            elif self.type == 'gz':
-                return self.archive.size
+                member = (self._7z_index or {}).get(filename)
+                return member['size'] if member else 0
             return 0
         except Exception as e:
             logger.error(f"获取文件信息失败: {str(e)}")
@@ -270,31 +333,147 @@ class ArchiveHandler:
             base_name = os.path.basename(filename)
             logger.info(f"正在检测文件: {base_name}")
             
-            if self.type == 'zip':
-                return self.archive.read(filename)
-            elif self.type == 'rar':
-                # 对于RAR文件，直接返回已解压文件的内容
-                if filename in self._extracted_files:
-                    with open(self._extracted_files[filename], 'rb') as f:
-                        return f.read()
-                raise Exception(f"文件 {filename} 未在提取列表中")
+            if self.type in ('zip', 'rar'):
+                with self.open_member(filename) as stream:
+                    return stream.read()
             elif self.type == '7z':
                 if filename in self._extracted_files:
                     with open(self._extracted_files[filename], 'rb') as f:
                         return f.read()
-                # 如果文件还未解压，则进行解压
-                if can_process_file(filename):
-                    self._extract_7z_files([filename])
-                    if filename in self._extracted_files:
-                        with open(self._extracted_files[filename], 'rb') as f:
-                            return f.read()
-                raise Exception(f"文件 {filename} 未找到在提取列表中")
-            elif self.type == 'gz':
-                return self.archive.read()
+                # 未预先解压的成员通过 7z x -so 流式读取
+                with self.open_member(filename) as stream:
+                    return stream.read()
+            elif self.type == 'compressed':
+                with self.open_member(filename) as stream:
+                    return stream.read()
             raise Exception("不支持的压缩格式")
+        except (zipfile.BadZipFile, zlib.error, rarfile.BadRarFile, rarfile.RarCRCError,
+                EOFError, gzip.BadGzipFile, lzma.LZMAError) as e:
+            raise Exception(f"压缩包成员 {filename} 已损坏: {str(e)}")
         except Exception as e:
             raise Exception(f"提取文件失败: {str(e)}")
 
+    def open_member(self, filename):
+        """以只读流的形式打开压缩包成员，数据在读取时才解压
+
+        ZIP 成员的 CRC 在读到末尾时校验，损坏时只有读取该成员会抛出 BadZipFile。
+        RAR 成员由 rarfile 通过 unrar p 输出到管道，7z 成员通过 7z x -so 输出到管道，
+        关闭流时结束解压进程，提前关闭就不会解压剩余数据。
+        tar 成员只能通过 iter_members 顺序读取。
+        """
+        if self.type in ('zip', 'rar'):
+            return self.archive.open(filename)
+        if self.type == '7z':
+            return PipeReader(['7z', 'x', '-so', '-spd', self.filepath, filename])
+        if self.type == 'compressed':
+            return self._open_stream()
+        raise Exception(f"{self.type} 格式不支持流式读取")
+
+    @contextmanager
+    def member_file(self, filename, cancel=None):
+        """以磁盘文件的形式提供压缩包成员，数据按块复制，不整体读入内存
+
+        已批量解压的 7z 成员直接使用解压出的文件；其它成员流式写入临时文件，
+        离开上下文后删除。
+
+        Args:
+            cancel: 可选的 threading.Event，复制过程中被设置时关闭成员流（结束解压进程）
+                并抛出 CancelledError
+
+        Yields:
+            成员文件在磁盘上的路径
+        """
+        if self.type == '7z' and filename in self._extracted_files:
+            path = self._extracted_files.pop(filename)
+            try:
+                yield path
+            finally:
+                if os.path.exists(path):
+                    os.unlink(path)
+            return
+
+        source = self.open_member(filename)
+        self.ensure_temp_dir()
+        path = os.path.join(self.temp_dir, self._generate_temp_filename(filename))
+        try:
+            with source, open(path, 'wb') as target:
+                for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                    if cancel is not None and cancel.is_set():
+                        raise CancelledError(f"已取消解压 {filename}")
+                    target.write(chunk)
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    @contextmanager
+    def member_buffer(self, filename, max_memory=NESTED_ARCHIVE_MEMORY_LIMIT, cancel=None):
+        """以可随机访问的文件对象提供成员，用于直接打开嵌套的 ZIP、tar 和压缩流
+
+        数据不超过 max_memory 时只保存在内存中，超过时转存到匿名临时文件，不需要经过文件路径。
+
+        Args:
+            cancel: 可选的 threading.Event，复制过程中被设置时关闭成员流并抛出 CancelledError
+
+        Yields:
+            位于开头的二进制文件对象
+        """
+        buffer = io.BytesIO()
+        try:
+            with self.open_member(filename) as source:
+                for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                    if cancel is not None and cancel.is_set():
+                        raise CancelledError(f"已取消解压 {filename}")
+                    if isinstance(buffer, io.BytesIO) and buffer.tell() + len(chunk) > max_memory:
+                        self.ensure_temp_dir()
+                        spilled = tempfile.TemporaryFile(dir=self.temp_dir)
+                        spilled.write(buffer.getbuffer())
+                        buffer.close()
+                        buffer = spilled
+                    buffer.write(chunk)
+            buffer.seek(0)
+            yield buffer
+        finally:
+            buffer.close()
+
+class _Unclosed(io.RawIOBase):
+    """包装调用方持有的文件对象，关闭包装时不关闭原对象"""
+    def __init__(self, raw):
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._raw.readinto(buffer)
+
+class PipeReader(io.RawIOBase):
+    """把子进程的标准输出包装成只读流，关闭时结束子进程"""
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self._process.stdout.readinto(buffer)
+        if not count:
+            # 读到末尾时检查退出码，解压失败不能当作正常结束
+            stderr = self._process.stderr.read().decode('utf-8', 'replace')
+            if self._process.wait() != 0:
+                raise Exception(f"{self.cmd[0]} 解压失败: {stderr.strip()}")
+        return count
+
+    def close(self):
+        if not self.closed:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.stdout.close()
+            self._process.stderr.close()
+            self._process.wait()
+        super().close()
+
 def get_file_extension(filename):
     return Path(filename).suffix.lower()
 
@@ -0,0 +1,293 @@
+# workers.py
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from config import (
+    MODEL_NAME, INFERENCE_BACKEND, BATCH_MAX_SIZE,
+    WORKER_PROCESSES, WORKER_TORCH_THREADS, WORKER_PIN_CPUS
+)
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+def _split_cpus(count):
+    """把当前进程可用的 CPU 平均分成 count 组"""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    groups = [cpus[index::count] for index in range(count)]
+    return [group or cpus for group in groups]
+
+def _worker_main(index, conn, shm_name, backend_name, model_name, torch_threads, cpus):
+    """模型工作进程入口：加载后端，循环处理共享内存中的批数据"""
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            logger.warning(f"工作进程 {index} 绑定 CPU 失败: {str(e)}")
+    # 必须在导入 torch 之前设置，控制 OpenMP/MKL 线程数
+    os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+    os.environ['MKL_NUM_THREADS'] = str(torch_threads)
+
+    shm = None
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+        from backends import create_backend
+        backend = create_backend(backend_name, model_name)
+        shm = shared_memory.SharedMemory(name=shm_name)
+        conn.send(('ready', os.getpid()))
+    except Exception as e:
+        conn.send(('error', f"工作进程初始化失败: {str(e)}"))
+        return
+
+    try:
+        while True:
+            shape = conn.recv()
+            if shape is None:
+                break
+            try:
+                pixel_values = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                conn.send(('ok', backend.classify_array(pixel_values)))
+            except Exception as e:
+                conn.send(('error', str(e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        shm.close()
+
+class _WorkerSlot:
+    """父进程中代表一个工作进程的句柄，工作进程重启后沿用同一个句柄"""
+    def __init__(self, index, cpus):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.shm = None
+        self.ready = False  # 模型已加载且管道可用；重启期间为 False，不参与调度
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.batches = 0
+        self.images = 0
+        self.restarts = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def alive(self):
+        return self.ready and self.process is not None and self.process.is_alive()
+
+class ModelWorkerPool:
+    """多进程模型工作池
+
+    每个工作进程绑定一组 CPU，使用独立的 torch 线程数加载模型。
+    父进程把预处理好的 NCHW 张量写入该进程专属的共享内存，
+    通过管道只传递形状，结果分数回传给调用方。
+    工作进程意外退出（OOM、段错误）后不再参与调度，并在后台用新的共享内存和管道重启。
+    """
+    def __init__(self, processes=WORKER_PROCESSES, torch_threads=WORKER_TORCH_THREADS,
+                 backend_name=INFERENCE_BACKEND, model_name=MODEL_NAME,
+                 input_size=(224, 224), max_batch_size=BATCH_MAX_SIZE, pin_cpus=WORKER_PIN_CPUS):
+        self.processes = max(1, int(processes))
+        self.backend_name = backend_name
+        self.model_name = model_name
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.height, self.width = input_size
+        self.pin_cpus = bool(pin_cpus)
+        cpu_groups = _split_cpus(self.processes)
+        self.torch_threads = int(torch_threads) or max(1, len(cpu_groups[0]))
+        self._cpu_groups = cpu_groups
+        self._slots = []
+        self._lock = threading.Lock()
+        self._started_at = None
+        self._closed = False
+        self._ctx = multiprocessing.get_context('spawn')
+        self._buffer_size = self.max_batch_size * 3 * self.height * self.width * 4
+
+    @property
+    def size(self):
+        return self.processes
+
+    @property
+    def supports_prescreen(self):
+        from backends import BACKENDS
+        backend_class = BACKENDS.get(str(self.backend_name).lower())
+        return bool(backend_class and backend_class.supports_prescreen)
+
+    @property
+    def healthy(self):
+        """是否还有可用的工作进程"""
+        return any(slot.alive for slot in self._slots)
+
+    def start(self):
+        """启动所有工作进程，并等待模型加载完成"""
+        for index in range(self.processes):
+            slot = _WorkerSlot(index, self._cpu_groups[index] if self.pin_cpus else None)
+            self._spawn(slot)
+            self._slots.append(slot)
+
+        for slot in self._slots:
+            try:
+                self._wait_ready(slot)
+            except Exception:
+                self.close()
+                raise
+        self._started_at = time.monotonic()
+        return self
+
+    def _spawn(self, slot):
+        """为 slot 创建共享内存和管道，并启动工作进程"""
+        slot.shm = shared_memory.SharedMemory(create=True, size=self._buffer_size)
+        parent_conn, child_conn = self._ctx.Pipe()
+        slot.process = self._ctx.Process(
+            target=_worker_main,
+            args=(slot.index, child_conn, slot.shm.name, self.backend_name, self.model_name,
+                  self.torch_threads, slot.cpus),
+            name=f'model-worker-{slot.index}',
+            daemon=True
+        )
+        slot.process.start()
+        child_conn.close()
+        slot.conn = parent_conn
+
+    def _wait_ready(self, slot):
+        """等待工作进程加载模型，失败时抛出 RuntimeError"""
+        try:
+            status, payload = slot.conn.recv()
+        except EOFError:
+            raise RuntimeError(f"工作进程 {slot.index} 启动时退出")
+        if status != 'ready':
+            raise RuntimeError(payload)
+        slot.ready = True
+        logger.info(f"模型工作进程 {slot.index} 已就绪: pid={payload}, "
+                    f"CPU={slot.cpus}, torch线程数={self.torch_threads}")
+
+    def _release(self, slot):
+        """结束 slot 当前的工作进程，释放管道和共享内存"""
+        slot.ready = False
+        if slot.conn is not None:
+            try:
+                slot.conn.send(None)
+            except Exception:
+                pass
+            slot.conn.close()
+        if slot.process is not None:
+            slot.process.join(timeout=5)
+            if slot.process.is_alive():
+                slot.process.terminate()
+                slot.process.join(timeout=5)
+        if slot.shm is not None:
+            slot.shm.close()
+            try:
+                slot.shm.unlink()
+            except FileNotFoundError:
+                pass
+        slot.process = slot.conn = slot.shm = None
+
+    def _restart(self, slot):
+        """在后台重启已退出的工作进程，重启完成前该 slot 不参与调度"""
+        with self._lock:
+            if self._closed or not slot.ready:
+                return
+            slot.ready = False
+        exitcode = slot.process.exitcode if slot.process is not None else None
+        logger.error(f"模型工作进程 {slot.index} 已退出 (exitcode={exitcode})，正在重启")
+
+        def run():
+            with slot.lock:
+                self._release(slot)
+                if self._closed:
+                    return
+                try:
+                    self._spawn(slot)
+                    self._wait_ready(slot)
+                    slot.restarts += 1
+                except Exception as e:
+                    logger.error(f"模型工作进程 {slot.index} 重启失败: {str(e)}")
+                    self._release(slot)
+
+        threading.Thread(target=run, name=f'model-worker-restart-{slot.index}', daemon=True).start()
+
+    def _acquire(self):
+        """选择排队最少的存活工作进程，发现已退出的进程时安排重启"""
+        for slot in self._slots:
+            if slot.ready and not slot.process.is_alive():
+                self._restart(slot)
+        with self._lock:
+            candidates = [slot for slot in self._slots if slot.ready]
+            if not candidates:
+                raise RuntimeError("没有可用的模型工作进程")
+            slot = min(candidates, key=lambda s: (s.pending, s.batches))
+            slot.pending += 1
+            return slot
+
+    def classify_array(self, pixel_values, retry=True):
+        """在工作进程中对 NCHW float32 批数据推理，返回 [(nsfw, normal)]
+
+        Args:
+            retry: 工作进程在推理过程中退出时，是否在其它工作进程上重试一次
+        """
+        if len(pixel_values) > self.max_batch_size:
+            scores = []
+            for start in range(0, len(pixel_values), self.max_batch_size):
+                scores.extend(self.classify_array(pixel_values[start:start + self.max_batch_size]))
+            return scores
+
+        slot = self._acquire()
+        crashed = True
+        try:
+            with slot.lock:
+                # 等待锁期间该进程可能已退出并开始重启
+                if slot.ready:
+                    start = time.monotonic()
+                    try:
+                        target = np.ndarray(pixel_values.shape, dtype=np.float32, buffer=slot.shm.buf)
+                        target[...] = pixel_values
+                        slot.conn.send(pixel_values.shape)
+                        status, payload = slot.conn.recv()
+                        crashed = False
+                        slot.batches += 1
+                        slot.images += len(pixel_values)
+                    except (EOFError, OSError):
+                        pass
+                    slot.busy_seconds += time.monotonic() - start
+        finally:
+            with self._lock:
+                slot.pending -= 1
+
+        if crashed:
+            self._restart(slot)
+            if retry:
+                # 批数据仍在父进程中，交给其它存活的工作进程重新推理一次
+                return self.classify_array(pixel_values, retry=False)
+            raise RuntimeError(f"工作进程 {slot.index} 已退出")
+        if status != 'ok':
+            raise RuntimeError(f"工作进程 {slot.index} 推理失败: {payload}")
+        return payload
+
+    def stats(self):
+        """每个工作进程的队列深度、利用率和重启次数"""
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        with self._lock:
+            return [{
+                'index': slot.index,
+                'pid': slot.process.pid if slot.process is not None else None,
+                'alive': slot.alive,
+                'cpus': slot.cpus,
+                'queue_depth': slot.pending,
+                'batches': slot.batches,
+                'images': slot.images,
+                'restarts': slot.restarts,
+                'utilization': round(slot.busy_seconds / uptime, 4) if uptime else 0.0
+            } for slot in self._slots]
+
+    def close(self):
+        self._closed = True
+        for slot in self._slots:
+            with slot.lock:
+                self._release(slot)
+        self._slots = []